@@ -16,9 +16,125 @@
     along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
 
-from medikom_back_end import Medikom
-from medikom_front_end import Gui
+import sys
+import time
+import argparse
+
+import medikom_log
+from medikom_back_end import Medikom, CachedMedikom
+from medikom_stats import Stats
 
 if __name__ == '__main__':
-    medikom = Medikom()
-    gui = Gui(medikom)
+    started = time.perf_counter()     # for Gui.first_paint
+    parser = argparse.ArgumentParser(description='Medikom')
+    parser.add_argument(
+        '--db', default='medikom.sqlite', help='database file')
+    parser.add_argument(
+        '--journal-mode', type=str.upper, default='DELETE',
+        choices=['DELETE', 'TRUNCATE', 'PERSIST', 'WAL'],
+        help='SQLite journal mode (default: DELETE, which works with a '
+             'database on a network share used by several workstations; '
+             'WAL is faster, but only for a database on a local disk)')
+    parser.add_argument(
+        '--store', metavar='DIR',
+        help='keep copies of attached files in DIR, named by their SHA-256')
+    parser.add_argument(
+        '--backup', metavar='DIR',
+        help='write checked snapshots of the database to DIR while the Gui '
+             'runs (and for the backup command)')
+    parser.add_argument(
+        '--backup-interval', type=int, default=60, metavar='MINUTES',
+        help='minutes between two snapshots (default: 60)')
+    parser.add_argument(
+        '--backup-keep', type=int, default=24, metavar='N',
+        help='number of snapshots kept (default: 24)')
+    parser.add_argument(
+        '--profile', action='store_true',
+        help='profile the Tk and worker threads with cProfile; on exit, '
+             'write medikom.prof (pstats, e.g. for snakeviz or flameprof) '
+             'and medikom-stats.txt')
+    commands = parser.add_subparsers(
+        dest='command', help='run headless instead of starting the Gui')
+    for name, help in (('export', 'write all entries to FILE'),
+                       ('import', 'add the entries of FILE as new entries')):
+        command = commands.add_parser(name, help=help)
+        command.add_argument('file', help="JSONL or CSV file, '-' for stdout/stdin")
+        command.add_argument(
+            '--format', choices=['jsonl', 'csv'],
+            help='file format (default: by suffix of FILE, else jsonl)')
+        command.add_argument(
+            '--quiet', action='store_true', help='no progress on stderr')
+    commands.choices['import'].add_argument(
+        '--batch-size', type=int, default=10000,
+        help='entries per transaction (default: 10000)')
+    commands.add_parser('stats', help='print numbers about the database')
+    commands.add_parser('backup', help='write a snapshot to the --backup directory')
+    commands.add_parser(
+        'restore', help='replace the database by the snapshot FILE'
+    ).add_argument('file', help='snapshot written by --backup')
+    args = parser.parse_args()
+    if args.command == 'backup' and args.backup is None:
+        parser.error('backup needs --backup DIR')
+
+    medikom_log.setup()
+    if args.command is not None:
+        import medikom_cli
+        medikom = Medikom(args.db, args.journal_mode)
+        if args.command == 'export':
+            medikom_cli.export(medikom, args.file, args.format, args.quiet)
+        elif args.command == 'import':
+            try:
+                medikom_cli.import_(
+                    medikom, args.file, args.format, args.batch_size, args.quiet)
+            except ValueError as error:
+                medikom.close()
+                parser.exit(1, "Import abgebrochen: %s\n" % error)
+        elif args.command == 'backup':
+            medikom_cli.backup(medikom, args.backup, args.backup_keep)
+        elif args.command == 'restore':
+            medikom_cli.restore(medikom, args.file)
+        else:
+            medikom_cli.stats(medikom)
+        medikom.close()
+    else:
+        from medikom_front_end import Gui
+        stats = Stats()
+        medikom = Medikom(args.db, args.journal_mode)
+        stats.instrument_medikom(medikom)
+        if args.profile:
+            import cProfile
+            import pstats
+            import threading
+            profilers = [cProfile.Profile()]
+
+            def profile_thread(*__):
+                # the database calls run on the worker thread: threads
+                # started from here on get a profiler of their own
+                sys.setprofile(None)
+                profiler = cProfile.Profile()
+                try:
+                    profiler.enable()
+                except ValueError:
+                    return  # one profiler for all threads (Python >= 3.12)
+                profilers.append(profiler)
+            threading.setprofile(profile_thread)
+            profilers[0].enable()
+        store = None
+        if args.store is not None:
+            from medikom_store import AttachmentStore
+            store = AttachmentStore(args.store)
+        scheduler = None
+        if args.backup is not None:
+            from medikom_backup import Backups, Scheduler
+            scheduler = Scheduler(
+                Backups(args.backup, args.backup_keep, stats), medikom,
+                args.backup_interval * 60)
+        gui = Gui(CachedMedikom(medikom), stats, store, started)
+        if scheduler is not None:
+            scheduler.stop()
+        if args.profile:
+            profilers[0].disable()
+            threading.setprofile(None)
+            pstats.Stats(*profilers).dump_stats('medikom.prof')
+            with open('medikom-stats.txt', 'w') as f:
+                f.write(stats.report())
@@ -17,124 +17,1255 @@
 """
 
 import time
+import queue
+import codecs
 import sqlite3
 import logging
+import threading
+import traceback
+from contextlib import contextmanager
+from collections import namedtuple, OrderedDict
+
+from medikom_log import log_event
+from medikom_revisions import (
+    SNAPSHOT_INTERVAL, encode_snapshot, encode_delta, decode)
+
+# kinds of changes published by Medikom
+INSERTED = 'inserted'
+UPDATED = 'updated'
+DELETED = 'deleted'
+
+Change = namedtuple('Change', ['kind', 'id', 'type', 'ts', 'title'])
+
+# types of entries: tasks and infos, the two columns of the overview
+ENTRY_TYPES = (0, 1)
+
+# version of the database schema, stored in PRAGMA user_version
+SCHEMA_VERSION = 7
+
 
 class Medikom(object):
     """ This class provides the back-end functionality of Medikom: data
     management of tasks and information."""
-    def __init__(self):
-        logging.basicConfig(
-            filename="medikom.log",
-            level=logging.INFO,
-            style="{",
-            format="{asctime} [{levelname}] {message}",
-            datefmt="%d.%m.%Y %H:%M:%S")
-        self.con = sqlite3.connect('medikom.sqlite')
-        self.cursor = self.con.cursor()
+    def __init__(self, path='medikom.sqlite', journal_mode='DELETE',
+                 synchronous='NORMAL', cache_size=-8000, timeout=30):
+        self.path = path
+        self.pragmas = (journal_mode, synchronous, cache_size)
+        self.timeout = timeout
+        self.local = threading.local()
+        self.connections = []   # all connections, one per thread
+        self.lock = threading.Lock()
+        self.subscribers = []
+        self.instrumentation = None     # see medikom_stats.Stats
+        # the database is opened and upgraded by the first connection, so
+        # that creating Medikom does no I/O
+        self.migrate_lock = threading.Lock()
+        self.migrated = False
+
+    @property
+    def con(self):
+        """The connection of the calling thread, opened on first use.
+        sqlite3 connections must not be shared between threads."""
         try:
-            self.current_id()
-        except sqlite3.OperationalError:
-            self.install()
+            return self.local.con
+        except AttributeError:
+            return self.connect()
+
+    @property
+    def cursor(self):
+        try:
+            return self.local.cursor
+        except AttributeError:
+            self.connect()
+            return self.local.cursor
+
+    def connect(self):
+        # writers wait up to 'timeout' seconds for a lock instead of failing
+        # with "database is locked"
+        con = sqlite3.connect(
+            self.path, timeout=self.timeout, check_same_thread=False)
+        self.local.con = con
+        if self.instrumentation is not None:
+            self.local.cursor = self.instrumentation.connect(con)
+        else:
+            self.local.cursor = con.cursor()
+        self.local.depth = 0     # nesting depth of transaction()
+        self.local.pending = []  # changes to publish once the transaction commits
+        try:
+            self.configure(*self.pragmas)
+            self.cursor.execute("PRAGMA foreign_keys = ON")
+            with self.migrate_lock:
+                if not self.migrated:
+                    self.migrate()
+                    self.migrated = True
+        except BaseException:
+            # e.g. locked past the timeout: the next call connects (and
+            # migrates) again
+            con.close()
+            del self.local.con, self.local.cursor
+            raise
+        with self.lock:
+            self.connections.append(con)
+        return con
+
+    def close(self):
+        """Closes the connections of all threads."""
+        with self.lock:
+            connections, self.connections = self.connections, []
+        for con in connections:
+            con.close()
+        self.local = threading.local()
+
+    def configure(self, journal_mode, synchronous, cache_size):
+        """Sets the journal mode (WAL needs one fsync per checkpoint instead
+        of one per transaction, but does not work on network shares; use
+        'DELETE' there), the fsync level and the page cache size (negative:
+        KiB)."""
+        if journal_mode.upper() not in ('DELETE', 'TRUNCATE', 'PERSIST', 'MEMORY', 'WAL', 'OFF'):
+            raise ValueError("unknown journal mode: %r" % journal_mode)
+        if synchronous.upper() not in ('OFF', 'NORMAL', 'FULL', 'EXTRA'):
+            raise ValueError("unknown synchronous level: %r" % synchronous)
+        self.cursor.execute("PRAGMA journal_mode = %s" % journal_mode)
+        self.cursor.execute("PRAGMA synchronous = %s" % synchronous)
+        self.cursor.execute("PRAGMA cache_size = %i" % int(cache_size))
+
+    def schema_version(self):
+        self.cursor.execute("PRAGMA user_version")
+        version = self.cursor.fetchone()[0]
+        if version == 0:
+            # databases of medikom <= 2.0 have no user_version
+            self.cursor.execute(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'entries'")
+            if self.cursor.fetchone():
+                version = 1
+        return version
+
+    def migrate(self, target=SCHEMA_VERSION):
+        """Upgrades the database in place, one schema version at a time.
+        Each step runs in its own write transaction and re-reads the version
+        under the lock, so that instances started at the same time on the
+        same database upgrade it once."""
+        migrations = {
+            0: self.install, 1: self.migrate_v2, 2: self.migrate_v3,
+            3: self.migrate_v4, 4: self.migrate_v5, 5: self.migrate_v6,
+            6: self.migrate_v7}
+        while self.schema_version() < target:
+            # foreign keys can only be switched outside of a transaction;
+            # migrate_v2 rebuilds the tables they refer to
+            self.cursor.execute("PRAGMA foreign_keys = OFF")
+            try:
+                self.cursor.execute("BEGIN IMMEDIATE")
+                try:
+                    version = self.schema_version()
+                    if version < target:
+                        migrations[version]()
+                    self.con.commit()
+                except BaseException:
+                    self.con.rollback()
+                    raise
+            finally:
+                self.cursor.execute("PRAGMA foreign_keys = ON")
+
+    def execute_script(self, script):
+        """Runs the statements of 'script' one by one in the open
+        transaction (executescript would commit it first)."""
+        statement = ''
+        for line in script.splitlines(keepends=True):
+            statement += line
+            if sqlite3.complete_statement(statement):
+                self.cursor.execute(statement)
+                statement = ''
 
     def install(self):
-        with self.con:
-            logging.info("Installiere Datenbank ...")
-            # install medikom database
-            self.cursor.execute("CREATE TABLE configuration(option TEXT, value INT)")
+        """Installs schema version 1."""
+        # install medikom database
+        self.cursor.execute("CREATE TABLE configuration(option TEXT, value INT)")
+        self.cursor.execute((
+            "CREATE TABLE entries( "
+            "id INT, type INT, ts INT, title TEXT, notes TEXT, "
+            "PRIMARY KEY(id))"))
+        self.cursor.execute((
+            "CREATE TABLE attachments("
+            "id INT, attachment TEXT, "
+            "PRIMARY KEY(id, attachment), "
+            "FOREIGN KEY(id) REFERENCES entries)"))
+
+        # insert default value(s)
+        self.cursor.execute("INSERT INTO configuration VALUES('current_id', '0')")
+        self.cursor.execute("PRAGMA user_version = 1")
+        log_event('migrate', version=1)
+
+    def migrate_v2(self):
+        """Schema version 2: ids from AUTOINCREMENT instead of the
+        configuration table, attachments deleted by ON DELETE CASCADE and a
+        covering index for the overview queries."""
+        start = time.perf_counter()
+        self.cursor.execute(
+            "SELECT value FROM configuration WHERE option = 'current_id'")
+        current_id = int(self.cursor.fetchone()[0])
+        self.execute_script('''
+            CREATE TABLE entries_v2(
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                type INT, ts INT, title TEXT, notes TEXT);
+            INSERT INTO entries_v2 SELECT id, type, ts, title, notes FROM entries;
+            CREATE TABLE attachments_v2(
+                id INTEGER, attachment TEXT,
+                PRIMARY KEY(id, attachment),
+                FOREIGN KEY(id) REFERENCES entries(id) ON DELETE CASCADE);
+            INSERT INTO attachments_v2
+                SELECT id, attachment FROM attachments
+                WHERE id IN (SELECT id FROM entries);
+            DROP TABLE attachments;
+            DROP TABLE entries;
+            DROP TABLE configuration;
+            ALTER TABLE entries_v2 RENAME TO entries;
+            ALTER TABLE attachments_v2 RENAME TO attachments;
+            CREATE INDEX entries_overview ON entries(type, ts DESC, id DESC, title);
+            ''')
+        if current_id > 0:
+            # never hand out an id again that was used before the upgrade
+            self.cursor.execute("DELETE FROM sqlite_sequence WHERE name = 'entries'")
             self.cursor.execute((
-                "CREATE TABLE entries( "
-                "id INT, type INT, ts INT, title TEXT, notes TEXT, "
-                "PRIMARY KEY(id))"))
+                "INSERT INTO sqlite_sequence(name, seq) "
+                "SELECT 'entries', MAX(?, IFNULL(MAX(id), 0)) FROM entries"),
+                (current_id - 1,))
+        self.cursor.execute("PRAGMA user_version = 2")
+        log_event('migrate', start, version=2)
+
+    def migrate_v3(self):
+        """Schema version 3: full-text index over titles, notes and
+        attachments, kept in sync by triggers. Diacritics are removed by the
+        tokenizer, so 'Muller' finds 'Müller'."""
+        start = time.perf_counter()
+        self.execute_script('''
+            CREATE VIRTUAL TABLE search USING fts5(
+                title, notes, attachments,
+                tokenize = 'unicode61 remove_diacritics 2');
+            INSERT INTO search(rowid, title, notes, attachments)
+                SELECT id, title, notes,
+                    (SELECT group_concat(attachment, ' ') FROM attachments
+                     WHERE attachments.id = entries.id)
+                FROM entries;
+            CREATE TRIGGER search_entry_insert AFTER INSERT ON entries BEGIN
+                INSERT INTO search(rowid, title, notes, attachments)
+                    VALUES(new.id, new.title, new.notes, '');
+            END;
+            CREATE TRIGGER search_entry_update AFTER UPDATE OF title, notes ON entries BEGIN
+                UPDATE search SET title = new.title, notes = new.notes
+                    WHERE rowid = new.id;
+            END;
+            CREATE TRIGGER search_entry_delete AFTER DELETE ON entries BEGIN
+                DELETE FROM search WHERE rowid = old.id;
+            END;
+            CREATE TRIGGER search_attachment_insert AFTER INSERT ON attachments BEGIN
+                UPDATE search SET attachments = (
+                    SELECT group_concat(attachment, ' ') FROM attachments
+                    WHERE id = new.id) WHERE rowid = new.id;
+            END;
+            CREATE TRIGGER search_attachment_delete AFTER DELETE ON attachments BEGIN
+                UPDATE search SET attachments = (
+                    SELECT group_concat(attachment, ' ') FROM attachments
+                    WHERE id = old.id) WHERE rowid = old.id;
+            END;
+            PRAGMA user_version = 3;
+            ''')
+        log_event('migrate', start, version=3)
+
+    def migrate_v4(self):
+        """Schema version 4: change log of entries, written by triggers, so
+        that other instances can find out which entries changed."""
+        start = time.perf_counter()
+        self.execute_script('''
+            CREATE TABLE changes(
+                seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                id INTEGER, type INT, ts REAL);
+            CREATE TRIGGER changes_entry_insert AFTER INSERT ON entries BEGIN
+                INSERT INTO changes(id, type, ts)
+                    VALUES(new.id, new.type, (julianday('now') - 2440587.5) * 86400.0);
+            END;
+            CREATE TRIGGER changes_entry_update AFTER UPDATE ON entries BEGIN
+                INSERT INTO changes(id, type, ts)
+                    VALUES(new.id, new.type, (julianday('now') - 2440587.5) * 86400.0);
+            END;
+            CREATE TRIGGER changes_entry_delete AFTER DELETE ON entries BEGIN
+                INSERT INTO changes(id, type, ts)
+                    VALUES(old.id, old.type, (julianday('now') - 2440587.5) * 86400.0);
+            END;
+            PRAGMA user_version = 4;
+            ''')
+        log_event('migrate', start, version=4)
+
+    def migrate_v5(self):
+        """Schema version 5: archive of completed entries with their
+        attachments and its own full-text index, so that the entries table
+        only holds open entries."""
+        start = time.perf_counter()
+        self.execute_script('''
+            CREATE TABLE archive(
+                id INTEGER PRIMARY KEY,
+                type INT, ts INT, title TEXT, notes TEXT, archived REAL);
+            CREATE TABLE archive_attachments(
+                id INTEGER, attachment TEXT,
+                PRIMARY KEY(id, attachment),
+                FOREIGN KEY(id) REFERENCES archive(id) ON DELETE CASCADE);
+            CREATE INDEX archive_overview ON archive(archived DESC, id DESC, type, title);
+            CREATE VIRTUAL TABLE archive_search USING fts5(
+                title, notes, attachments,
+                tokenize = 'unicode61 remove_diacritics 2');
+            CREATE TRIGGER archive_search_insert AFTER INSERT ON archive BEGIN
+                INSERT INTO archive_search(rowid, title, notes, attachments)
+                    VALUES(new.id, new.title, new.notes, '');
+            END;
+            CREATE TRIGGER archive_search_delete AFTER DELETE ON archive BEGIN
+                DELETE FROM archive_search WHERE rowid = old.id;
+            END;
+            CREATE TRIGGER archive_search_attachments AFTER INSERT ON archive_attachments BEGIN
+                UPDATE archive_search SET attachments = (
+                    SELECT group_concat(attachment, ' ') FROM archive_attachments
+                    WHERE id = new.id) WHERE rowid = new.id;
+            END;
+            PRAGMA user_version = 5;
+            ''')
+        log_event('migrate', start, version=5)
+
+    def migrate_v6(self):
+        """Schema version 6: revisions of the notes, each a compressed delta
+        against the previous revision or a full snapshot (see
+        medikom_revisions). There is no foreign key, so that the revisions
+        of archived entries are kept."""
+        start = time.perf_counter()
+        self.execute_script('''
+            CREATE TABLE revisions(
+                id INTEGER, rev INTEGER, ts REAL, snapshot INT, data BLOB,
+                PRIMARY KEY(id, rev));
+            PRAGMA user_version = 6;
+            ''')
+        log_event('migrate', start, version=6)
+
+    def migrate_v7(self):
+        """Schema version 7: files of the attachment store (see
+        medikom_store), referenced by the sha256 of attachments. Triggers
+        count the references of each file, so that unreferenced files can
+        be deleted."""
+        start = time.perf_counter()
+        self.execute_script('''
+            CREATE TABLE blobs(
+                sha256 TEXT PRIMARY KEY, size INT, filename TEXT,
+                refs INT DEFAULT 0, status TEXT DEFAULT 'ok', checked REAL);
+            CREATE INDEX blobs_unreferenced ON blobs(refs) WHERE refs = 0;
+            ALTER TABLE attachments ADD COLUMN sha256 TEXT;
+            ALTER TABLE archive_attachments ADD COLUMN sha256 TEXT;
+            CREATE TRIGGER blobs_attachment_insert AFTER INSERT ON attachments
+            WHEN new.sha256 IS NOT NULL BEGIN
+                UPDATE blobs SET refs = refs + 1 WHERE sha256 = new.sha256;
+            END;
+            CREATE TRIGGER blobs_attachment_delete AFTER DELETE ON attachments
+            WHEN old.sha256 IS NOT NULL BEGIN
+                UPDATE blobs SET refs = refs - 1 WHERE sha256 = old.sha256;
+            END;
+            CREATE TRIGGER blobs_archive_insert AFTER INSERT ON archive_attachments
+            WHEN new.sha256 IS NOT NULL BEGIN
+                UPDATE blobs SET refs = refs + 1 WHERE sha256 = new.sha256;
+            END;
+            CREATE TRIGGER blobs_archive_delete AFTER DELETE ON archive_attachments
+            WHEN old.sha256 IS NOT NULL BEGIN
+                UPDATE blobs SET refs = refs - 1 WHERE sha256 = old.sha256;
+            END;
+            PRAGMA user_version = 7;
+            ''')
+        log_event('migrate', start, version=7)
+
+    def subscribe(self, callback, polled=True):
+        """Registers 'callback', which is called with a Change after each
+        committed mutation, on the thread that made the mutation. Unless
+        'polled' is false, it is also called with each change found by
+        poll_changes (whose caller gets them as one list anyway)."""
+        self.subscribers.append((callback, polled))
+
+    def publish(self, change, polled=False):
+        if getattr(self.local, 'depth', 0):
+            self.local.pending.append(change)
+            return
+        for callback, wants_polled in self.subscribers:
+            if wants_polled or not polled:
+                callback(change)
+
+    @contextmanager
+    def transaction(self):
+        """Runs the enclosed statements in one transaction. Nested
+        transactions join the outermost one, which commits (or rolls back)
+        once; its changes are published after the commit."""
+        con = self.con
+        local = self.local
+        outermost = not local.depth
+        local.depth += 1
+        try:
+            if outermost:
+                with con:
+                    yield
+            else:
+                yield
+        except BaseException:
+            if outermost:
+                local.pending = []
+            raise
+        finally:
+            local.depth -= 1
+        if outermost:
+            pending, local.pending = local.pending, []
+            for change in pending:
+                self.publish(change)
+
+    def bulk(self):
+        """Returns a context manager that applies all enclosed Medikom calls
+        in a single transaction (and a single fsync):
+
+            with medikom.bulk():
+                for title in titles:
+                    medikom.add_entry(0, title, '')
+        """
+        return self.transaction()
+
+    def changed(self, id):
+        """Publishes an update of entry 'id' with its current header."""
+        self.cursor.execute(
+            "SELECT type, ts, title FROM entries WHERE id = ?", (id,))
+        row = self.cursor.fetchone()
+        if row:
+            self.publish(Change(UPDATED, id, *row))
+
+    def change_position(self):
+        """Gets the position of the latest change in the change log."""
+        self.cursor.execute(
+            "SELECT seq FROM sqlite_sequence WHERE name = 'changes'")
+        row = self.cursor.fetchone()
+        return row[0] if row else 0
+
+    def poll_changes(self, since):
+        """Gets the changes committed by other connections (other instances
+        or threads) after change log position 'since'. Returns the changes
+        (one per entry) and the new position; the changes are also published
+        to the subscribers. If nothing was committed, this costs one PRAGMA
+        data_version. Instead of the changes, None is returned if the log
+        has been pruned beyond 'since'."""
+        self.cursor.execute("PRAGMA data_version")
+        data_version = self.cursor.fetchone()[0]
+        if data_version == getattr(self.local, 'data_version', None):
+            return [], since
+        with self.transaction():
+            position = self.change_position()
+            if position <= since:
+                self.local.data_version = data_version
+                return [], since
+            self.cursor.execute("SELECT MIN(seq) FROM changes")
+            first = self.cursor.fetchone()[0]
+            if first is None or first > since + 1:
+                self.local.data_version = data_version
+                return None, position
             self.cursor.execute((
-                "CREATE TABLE attachments("
-                "id INT, attachment TEXT, "
-                "PRIMARY KEY(id, attachment), "
-                "FOREIGN KEY(id) REFERENCES entries)"))
+                "SELECT changes.id, changes.type, entries.type, entries.ts, entries.title "
+                "FROM (SELECT id, type, MAX(seq) FROM changes WHERE seq > ? AND seq <= ? "
+                "      GROUP BY id) AS changes "
+                "LEFT JOIN entries ON entries.id = changes.id"), (since, position))
+            changes = []
+            for id, old_type, entry_type, ts, title in self.cursor.fetchall():
+                if entry_type is None:
+                    changes.append(Change(DELETED, id, old_type, None, None))
+                else:
+                    changes.append(Change(UPDATED, id, entry_type, ts, title))
+        # only now: after a failed read, the next poll must read again
+        self.local.data_version = data_version
+        for change in changes:
+            self.publish(change, polled=True)
+        return changes, position
 
-            # insert default value(s)
-            self.cursor.execute("INSERT INTO configuration VALUES('current_id', '0')")
-            logging.info("Datenbankinstallation abgeschlossen.")
-            
+    def prune_changes(self, age=7 * 24 * 3600):
+        """Deletes change log rows older than 'age' seconds."""
+        with self.transaction():
+            self.cursor.execute(
+                "DELETE FROM changes WHERE ts < ?", (time.time() - age,))
 
     def current_id(self):
         """Gets id value for new entry."""
-        self.cursor.execute('SELECT * FROM configuration')
-        __, current_id = self.cursor.fetchone()
-        return int(current_id)
+        self.cursor.execute(
+            "SELECT seq FROM sqlite_sequence WHERE name = 'entries'")
+        row = self.cursor.fetchone()
+        return row[0] + 1 if row else 1
 
     def add_entry(self, entry_type, title, notes):
-        with self.con:
-            id = self.current_id()
+        start = time.perf_counter()
+        with self.transaction():
             ts = time.time()
-            query = "INSERT INTO entries VALUES(?, ?, ?, ?, ?)"
-            sqlinsert = (id, entry_type, ts, title, notes)
+            query = "INSERT INTO entries(type, ts, title, notes) VALUES(?, ?, ?, ?)"
+            sqlinsert = (entry_type, ts, title, notes)
             self.cursor.execute(query, sqlinsert)
-            self.cursor.execute((
-                "UPDATE configuration "
-                "SET value = %i "
-                "WHERE option = 'current_id'" % (id + 1)))
-            if entry_type == 0:
-                logging.info(
-                    "Neue Aufgabe '{title}' #{id} erstellt.".format(title=title, id=id))
-            else:
-                logging.info(
-                    "Neue Info '{title}' #{id} erstellt.".format(title=title, id=id))
+            id = self.cursor.lastrowid
+        log_event('add_entry', start, id=id, type=entry_type, title=title, size=len(notes))
+        self.publish(Change(INSERTED, id, entry_type, ts, title))
+        return id
+
+    def add_entries(self, entries):
+        """Adds all (entry_type, title, notes) of 'entries' with one
+        executemany in one transaction. Returns the new ids."""
+        ts = time.time()
+        rows = [(entry_type, ts, title, notes) for entry_type, title, notes in entries]
+        if not rows:
+            return []
+        with self.transaction():
+            self.cursor.executemany(
+                "INSERT INTO entries(type, ts, title, notes) VALUES(?, ?, ?, ?)", rows)
+            # AUTOINCREMENT ids are consecutive within the write transaction
+            first = self.current_id() - len(rows)
+            for id, (entry_type, ts, title, notes) in enumerate(rows, first):
+                self.publish(Change(INSERTED, id, entry_type, ts, title))
+                log_event('add_entry', id=id, type=entry_type, title=title, size=len(notes))
+        return list(range(first, first + len(rows)))
 
     def rm_entry(self, id):
-        with self.con:
-            self.cursor.execute("DELETE FROM attachments WHERE id = ?", (id,))
+        start = time.perf_counter()
+        with self.transaction():
+            self.cursor.execute(
+                "SELECT type, ts, title FROM entries WHERE id = ?", (id,))
+            row = self.cursor.fetchone()
+            # attachments are deleted by ON DELETE CASCADE
             self.cursor.execute("DELETE FROM entries WHERE id = ?", (id,))
-            logging.info("Eintrag #{id} gelöscht.".format(id=id))
+            self.cursor.execute("DELETE FROM revisions WHERE id = ?", (id,))
+        if row:
+            log_event('rm_entry', start, id=id, type=row[0])
+            self.publish(Change(DELETED, id, *row))
 
     def edit_title(self, id, new_title):
-        with self.con:
+        start = time.perf_counter()
+        with self.transaction():
             ts = time.time()
             query = "UPDATE entries SET title = ?, ts = ? WHERE id = ?"
             sqlinsert = (new_title, ts, id)
             self.cursor.execute(query, sqlinsert)
-            logging.info("Eintrag #{id} zu '{title}' umbenannt.".format(id=id, title=new_title))
+        log_event('edit_title', start, id=id, title=new_title)
+        self.changed(id)
 
-    def edit_notes(self, id, new_notes):
-        with self.con:
+    def edit_notes(self, id, new_notes, amend=None):
+        """Saves 'new_notes' and adds them as a revision, unless they are
+        unchanged. With 'amend', the number of a revision returned before,
+        that revision is replaced instead if it is still the latest one, so
+        that a series of saves makes one revision. Returns the number of
+        the revision."""
+        start = time.perf_counter()
+        with self.transaction():
+            self.begin_write()
+            self.cursor.execute(
+                "SELECT ts, notes FROM entries WHERE id = ?", (id,))
+            row = self.cursor.fetchone()
+            if row is None or row[1] == new_notes:
+                return
             ts = time.time()
             query = "UPDATE entries SET notes = ?, ts = ? WHERE id = ?"
             sqlinsert = (new_notes, ts, id)
             self.cursor.execute(query, sqlinsert)
-            logging.info("Eintrag #{id} editiert.".format(id=id))
+            rev = self.add_revision(
+                id, row[0], row[1] or '', ts, new_notes, amend)
+        # the notes are in revision 'rev', see medikom_log.replay
+        log_event('edit_notes', start, id=id, rev=rev, size=len(new_notes))
+        self.changed(id)
+        return rev
 
-    def add_attachment(self, id, attachment):
-        with self.con:
+    def add_revision(self, id, old_ts, old_notes, ts, new_notes, amend=None):
+        """Adds 'new_notes' as the next revision of the notes of entry 'id',
+        or replaces revision 'amend' if it is the latest one. Returns its
+        number."""
+        self.cursor.execute("SELECT MAX(rev) FROM revisions WHERE id = ?", (id,))
+        rev = self.cursor.fetchone()[0]
+        if rev is None:
+            # the notes before the first edit are the first revision
+            rev = 0
+            self.cursor.execute(
+                "INSERT INTO revisions VALUES(?, ?, ?, 1, ?)",
+                (id, rev, old_ts, encode_snapshot(old_notes)))
+        if amend is not None and amend == rev and rev > 0:
+            # another instance has not added a revision since: the delta is
+            # taken against the revision before the amended one
+            old_notes = self.get_revision(id, rev - 1)
+            self.cursor.execute(
+                "DELETE FROM revisions WHERE id = ? AND rev = ?", (id, rev))
+        else:
+            rev += 1
+        is_snapshot = rev % SNAPSHOT_INTERVAL == 0
+        if is_snapshot:
+            data = encode_snapshot(new_notes)
+        else:
+            data = encode_delta(old_notes, new_notes)
+            if len(data) > len(new_notes) // 2:
+                # most of the notes changed: a snapshot may be smaller
+                full = encode_snapshot(new_notes)
+                if len(full) <= len(data):
+                    data, is_snapshot = full, True
+        self.cursor.execute(
+            "INSERT INTO revisions VALUES(?, ?, ?, ?, ?)",
+            (id, rev, ts, int(is_snapshot), data))
+        return rev
+
+    def add_attachment(self, id, attachment, sha256=None):
+        """Adds the path 'attachment' to entry 'id'; 'sha256' refers to its
+        copy in the attachment store, see add_blob."""
+        start = time.perf_counter()
+        with self.transaction():
             ts = time.time()
-            self.cursor.execute("INSERT INTO attachments VALUES(?, ?)", (id, attachment))
+            self.cursor.execute(
+                "INSERT INTO attachments(id, attachment, sha256) VALUES(?, ?, ?)",
+                (id, attachment, sha256))
             self.cursor.execute("UPDATE entries SET ts = ? WHERE id = ?", (ts, id))
-            logging.info("Anhang '{attachment}' zu #{id} hinzugefügt.".format(id=id, attachment=attachment))
+        log_event('add_attachment', start, id=id, attachment=attachment, sha256=sha256)
+        self.changed(id)
+
+    def add_attachments(self, attachments):
+        """Adds all (id, attachment) of 'attachments' with one executemany
+        in one transaction."""
+        attachments = list(attachments)
+        ids = sorted({id for id, __ in attachments})
+        ts = time.time()
+        with self.transaction():
+            self.cursor.executemany(
+                "INSERT INTO attachments(id, attachment) VALUES(?, ?)", attachments)
+            self.cursor.executemany(
+                "UPDATE entries SET ts = ? WHERE id = ?", [(ts, id) for id in ids])
+            for id in ids:
+                self.changed(id)
+        for id, attachment in attachments:
+            log_event('add_attachment', id=id, attachment=attachment)
 
     def rm_attachment(self, id, attachment):
-        with self.con:
+        start = time.perf_counter()
+        with self.transaction():
             ts = time.time()
-            self.cursor.execute("DELETE FROM attachments WHERE attachment = ?", (attachment,))
+            self.cursor.execute(
+                "DELETE FROM attachments WHERE id = ? AND attachment = ?", (id, attachment))
             self.cursor.execute("UPDATE entries SET ts = ? WHERE id = ?", (ts, id))
-            logging.info("Anhang '{attachment}' von #{id} entfernt.".format(id=id, attachment=attachment))
+        log_event('rm_attachment', start, id=id, attachment=attachment)
+        self.changed(id)
+
+    def archive_entry(self, id):
+        """Moves entry 'id' and its attachments to the archive in one
+        transaction. For the overview, the entry is deleted."""
+        start = time.perf_counter()
+        with self.transaction():
+            self.cursor.execute(
+                "SELECT type, ts, title FROM entries WHERE id = ?", (id,))
+            row = self.cursor.fetchone()
+            if row is None:
+                return
+            self.cursor.execute((
+                "INSERT INTO archive(id, type, ts, title, notes, archived) "
+                "SELECT id, type, ts, title, notes, ? FROM entries WHERE id = ?"),
+                (time.time(), id))
+            self.cursor.execute((
+                "INSERT INTO archive_attachments(id, attachment, sha256) "
+                "SELECT id, attachment, sha256 FROM attachments WHERE id = ?"), (id,))
+            # attachments are deleted by ON DELETE CASCADE
+            self.cursor.execute("DELETE FROM entries WHERE id = ?", (id,))
+        log_event('archive_entry', start, id=id, type=row[0])
+        self.publish(Change(DELETED, id, *row))
+
+    def restore_entry(self, id):
+        """Moves entry 'id' and its attachments from the archive back to the
+        entries, with its id and time stamp."""
+        start = time.perf_counter()
+        with self.transaction():
+            self.cursor.execute(
+                "SELECT type, ts, title FROM archive WHERE id = ?", (id,))
+            row = self.cursor.fetchone()
+            if row is None:
+                return
+            self.cursor.execute((
+                "INSERT INTO entries(id, type, ts, title, notes) "
+                "SELECT id, type, ts, title, notes FROM archive WHERE id = ?"), (id,))
+            self.cursor.execute((
+                "INSERT INTO attachments(id, attachment, sha256) "
+                "SELECT id, attachment, sha256 FROM archive_attachments WHERE id = ?"), (id,))
+            self.cursor.execute("DELETE FROM archive WHERE id = ?", (id,))
+        log_event('restore_entry', start, id=id, type=row[0])
+        self.publish(Change(INSERTED, id, *row))
+
+    def add_blob(self, sha256, size, filename):
+        """Registers the file 'filename' of the attachment store with the
+        content 'sha256', unless it is known."""
+        with self.transaction():
+            self.cursor.execute((
+                "INSERT OR IGNORE INTO blobs(sha256, size, filename, checked) "
+                "VALUES(?, ?, ?, ?)"), (sha256, size, filename, time.time()))
+
+    def get_blob(self, sha256):
+        """Gets (filename, status) of file 'sha256' of the attachment store,
+        or None if it is unknown."""
+        with self.transaction():
+            self.cursor.execute(
+                "SELECT filename, status FROM blobs WHERE sha256 = ?", (sha256,))
+            return self.cursor.fetchone()
+
+    def iter_blobs(self, limit=1000):
+        """Yields (sha256, size, filename, status, checked) of all files of
+        the attachment store, in pages of 'limit'."""
+        after = ''
+        while True:
+            with self.transaction():
+                self.cursor.execute((
+                    "SELECT sha256, size, filename, status, checked FROM blobs "
+                    "WHERE sha256 > ? ORDER BY sha256 LIMIT ?"), (after, limit))
+                page = self.cursor.fetchall()
+            yield from page
+            if len(page) < limit:
+                return
+            after = page[-1][0]
+
+    def set_blob_status(self, sha256, status, checked=None):
+        """Sets the status found by the scanner of the attachment store;
+        'checked' is the time of the last full check of the content. A new
+        status is published, and logged for other instances, as an update
+        of the entries with the file attached, whose headers show it."""
+        with self.transaction():
+            self.begin_write()
+            self.cursor.execute(
+                "SELECT status FROM blobs WHERE sha256 = ?", (sha256,))
+            row = self.cursor.fetchone()
+            self.cursor.execute((
+                "UPDATE blobs SET status = ?, checked = IFNULL(?, checked) "
+                "WHERE sha256 = ?"), (status, checked, sha256))
+            if row is None or row[0] == status:
+                return
+            self.cursor.execute(
+                "SELECT DISTINCT id FROM attachments WHERE sha256 = ?", (sha256,))
+            ids = [id for id, in self.cursor.fetchall()]
+            self.cursor.executemany((
+                "INSERT INTO changes(id, type, ts) "
+                "SELECT id, type, ? FROM entries WHERE id = ?"),
+                [(time.time(), id) for id in ids])
+            for id in ids:
+                self.changed(id)
+
+    def unreferenced_blobs(self):
+        """Gets (sha256, filename) of the files no attachment refers to."""
+        with self.transaction():
+            self.cursor.execute(
+                "SELECT sha256, filename FROM blobs WHERE refs = 0")
+            return self.cursor.fetchall()
+
+    def delete_blob(self, sha256):
+        """Unregisters file 'sha256' if it is still unreferenced. Returns
+        whether it was."""
+        with self.transaction():
+            self.cursor.execute(
+                "DELETE FROM blobs WHERE sha256 = ? AND refs = 0", (sha256,))
+            return self.cursor.rowcount == 1
 
     def get_titles(self):
-        with self.con:
+        with self.transaction():
             self.cursor.execute(
-                "SELECT id, ts, title FROM entries WHERE type = 0 ORDER BY ts DESC")
+                "SELECT id, ts, title FROM entries WHERE type = 0 ORDER BY ts DESC, id DESC")
             tasks_results = self.cursor.fetchall()
             self.cursor.execute(
-                "SELECT id, ts, title FROM entries WHERE type = 1 ORDER BY ts DESC")
+                "SELECT id, ts, title FROM entries WHERE type = 1 ORDER BY ts DESC, id DESC")
             information_results = self.cursor.fetchall()
             return tasks_results, information_results
 
+    def count_entries(self, entry_type):
+        with self.transaction():
+            self.cursor.execute(
+                "SELECT COUNT(*) FROM entries WHERE type = ?", (entry_type,))
+            return self.cursor.fetchone()[0]
+
+    def get_titles_page(self, entry_type, offset, limit):
+        """Gets 'limit' titles of type 'entry_type', starting at row 'offset'
+        of the overview order (newest first)."""
+        with self.transaction():
+            self.cursor.execute((
+                "SELECT id, ts, title FROM entries WHERE type = ? "
+                "ORDER BY ts DESC, id DESC LIMIT ? OFFSET ?"),
+                (entry_type, limit, offset))
+            return self.cursor.fetchall()
+
+    def search(self, query, entry_type=None, limit=100):
+        """Finds entries whose title, notes or attachments contain words
+        starting with the words of 'query'. Returns (id, type, ts, title),
+        best matches (bm25, titles weighted highest) first."""
+        match = self.match(query)
+        if not match:
+            return []
+        sql = (
+            "SELECT entries.id, entries.type, entries.ts, entries.title "
+            "FROM search JOIN entries ON entries.id = search.rowid "
+            "WHERE search MATCH ? ")
+        params = [match]
+        if entry_type is not None:
+            sql += "AND entries.type = ? "
+            params.append(entry_type)
+        sql += "ORDER BY bm25(search, 10.0, 1.0, 2.0) LIMIT ?"
+        params.append(limit)
+        with self.transaction():
+            self.cursor.execute(sql, params)
+            return self.cursor.fetchall()
+
+    def list_revisions(self, id):
+        """Gets (rev, ts, size) of all revisions of the notes of entry 'id',
+        oldest first; size is the number of stored bytes."""
+        with self.transaction():
+            self.cursor.execute((
+                "SELECT rev, ts, length(data) FROM revisions "
+                "WHERE id = ? ORDER BY rev"), (id,))
+            return self.cursor.fetchall()
+
+    def get_revision(self, id, rev):
+        """Gets the notes of entry 'id' as of revision 'rev', rebuilt from the
+        latest snapshot before it, or None if there is no such revision."""
+        with self.transaction():
+            self.cursor.execute((
+                "SELECT rev, snapshot, data FROM revisions "
+                "WHERE id = ? AND rev <= ? AND rev >= ("
+                "    SELECT MAX(rev) FROM revisions "
+                "    WHERE id = ? AND rev <= ? AND snapshot) "
+                "ORDER BY rev"), (id, rev, id, rev))
+            rows = self.cursor.fetchall()
+        if not rows or rows[-1][0] != rev:
+            return None
+        notes = None
+        for __, is_snapshot, data in rows:
+            notes = decode(data, is_snapshot, notes)
+        return notes
+
+    def diff_revisions(self, id, rev_a, rev_b):
+        """Returns the unified diff from revision 'rev_a' to 'rev_b' of the
+        notes of entry 'id'."""
+        import difflib
+        a = (self.get_revision(id, rev_a) or '').splitlines()
+        b = (self.get_revision(id, rev_b) or '').splitlines()
+        return '\n'.join(difflib.unified_diff(
+            a, b, 'Version %i' % rev_a, 'Version %i' % rev_b, lineterm=''))
+
+    def match(self, query):
+        """Returns the full-text query for words starting with the words of
+        'query'."""
+        return ' '.join(
+            '"%s"*' % term.replace('"', '""') for term in query.split())
+
+    def count_archive(self, entry_type=None):
+        with self.transaction():
+            if entry_type is None:
+                self.cursor.execute("SELECT COUNT(*) FROM archive")
+            else:
+                self.cursor.execute(
+                    "SELECT COUNT(*) FROM archive WHERE type = ?", (entry_type,))
+            return self.cursor.fetchone()[0]
+
+    def get_archive_page(self, after=None, limit=50, entry_type=None):
+        """Gets (id, type, ts, title, archived) of 'limit' archived entries,
+        most recently archived first, starting after the row 'after' (the
+        last row of the previous page). Pages are found by keyset
+        pagination on the index, so no page scans the rows before it."""
+        sql = "SELECT id, type, ts, title, archived FROM archive "
+        conditions = []
+        params = []
+        if after is not None:
+            conditions.append("(archived, id) < (?, ?)")
+            params += [after[4], after[0]]
+        if entry_type is not None:
+            conditions.append("type = ?")
+            params.append(entry_type)
+        if conditions:
+            sql += "WHERE " + " AND ".join(conditions) + " "
+        sql += "ORDER BY archived DESC, id DESC LIMIT ?"
+        params.append(limit)
+        with self.transaction():
+            self.cursor.execute(sql, params)
+            return self.cursor.fetchall()
+
+    def search_archive(self, query, entry_type=None, limit=100):
+        """Like search, for archived entries. Returns (id, type, ts, title,
+        archived)."""
+        match = self.match(query)
+        if not match:
+            return []
+        sql = (
+            "SELECT archive.id, archive.type, archive.ts, archive.title, "
+            "archive.archived "
+            "FROM archive_search JOIN archive ON archive.id = archive_search.rowid "
+            "WHERE archive_search MATCH ? ")
+        params = [match]
+        if entry_type is not None:
+            sql += "AND archive.type = ? "
+            params.append(entry_type)
+        sql += "ORDER BY bm25(archive_search, 10.0, 1.0, 2.0) LIMIT ?"
+        params.append(limit)
+        with self.transaction():
+            self.cursor.execute(sql, params)
+            return self.cursor.fetchall()
+
+    def get_archived_entry(self, id):
+        """Like get_entry, for an archived entry."""
+        with self.transaction():
+            self.cursor.execute(
+                "SELECT ts, title, notes FROM archive WHERE id = ?", (id,))
+            entry_results = self.cursor.fetchone()
+            self.cursor.execute(
+                "SELECT attachment, filename, status FROM archive_attachments "
+                "LEFT JOIN blobs USING(sha256) WHERE id = ?", (id,))
+            attachments = self.cursor.fetchall()
+            return entry_results, attachments
+
+    def iter_titles(self, entry_type, after_ts=None, after_id=None, limit=1000):
+        """Yields (id, ts, title) of type 'entry_type' in overview order,
+        starting after the entry (after_ts, after_id). Rows are fetched in
+        pages of 'limit' with keyset pagination on the index, so memory does
+        not grow with the number of entries and no page scans the rows
+        before it."""
+        while True:
+            with self.transaction():
+                if after_ts is None:
+                    self.cursor.execute((
+                        "SELECT id, ts, title FROM entries WHERE type = ? "
+                        "ORDER BY ts DESC, id DESC LIMIT ?"), (entry_type, limit))
+                else:
+                    self.cursor.execute((
+                        "SELECT id, ts, title FROM entries "
+                        "WHERE type = ? AND (ts, id) < (?, ?) "
+                        "ORDER BY ts DESC, id DESC LIMIT ?"),
+                        (entry_type, after_ts, after_id, limit))
+                page = self.cursor.fetchall()
+            yield from page
+            if len(page) < limit:
+                return
+            after_id, after_ts, __ = page[-1]
+
     def get_entry(self, id):
-        with self.con:
+        with self.transaction():
             self.cursor.execute((
                 "SELECT ts, title, notes FROM entries "
                 "WHERE id = ? ORDER BY ts"), (id,))
             entry_results = self.cursor.fetchone()
             self.cursor.execute(
-                "SELECT attachment FROM attachments WHERE id = ?", (id,))
+                "SELECT attachment, filename, status FROM attachments "
+                "LEFT JOIN blobs USING(sha256) WHERE id = ?", (id,))
+            attachments = self.cursor.fetchall()
+            return entry_results, attachments
+
+    def get_header(self, id):
+        """Like get_entry, but without the notes: returns (ts, title) and
+        the attachments as (attachment, filename, status), where filename
+        and status are those of the copy in the attachment store, or None.
+        See iter_notes."""
+        with self.transaction():
+            self.cursor.execute(
+                "SELECT ts, title FROM entries WHERE id = ?", (id,))
+            entry_results = self.cursor.fetchone()
+            self.cursor.execute(
+                "SELECT attachment, filename, status FROM attachments "
+                "LEFT JOIN blobs USING(sha256) WHERE id = ?", (id,))
             attachments = self.cursor.fetchall()
             return entry_results, attachments
 
+    def iter_notes(self, id, chunk_size=64 * 1024):
+        """Yields the notes of entry 'id' in pieces of about 'chunk_size'
+        bytes, read with incremental blob I/O, so that long notes are never
+        loaded at once."""
+        decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        try:
+            blob = self.con.blobopen('entries', 'notes', id, readonly=True)
+        except sqlite3.OperationalError:
+            return  # no such entry, or notes are NULL
+        with blob:
+            while True:
+                data = blob.read(chunk_size)
+                if not data:
+                    break
+                text = decoder.decode(data)
+                if text:
+                    yield text
+        text = decoder.decode(b'', final=True)
+        if text:
+            yield text
+
+    def iter_entries(self, limit=1000):
+        """Yields (id, type, ts, title, notes, attachments) of all entries
+        in order of id. Entries are fetched in pages of 'limit' with keyset
+        pagination, so memory does not grow with the number of entries."""
+        after_id = 0
+        while True:
+            with self.transaction():
+                self.cursor.execute((
+                    "SELECT id, type, ts, title, notes FROM entries "
+                    "WHERE id > ? ORDER BY id LIMIT ?"), (after_id, limit))
+                page = self.cursor.fetchall()
+                if not page:
+                    return
+                attachments = {}
+                self.cursor.execute((
+                    "SELECT id, attachment FROM attachments "
+                    "WHERE id BETWEEN ? AND ? ORDER BY id, attachment"),
+                    (page[0][0], page[-1][0]))
+                for id, attachment in self.cursor:
+                    attachments.setdefault(id, []).append(attachment)
+            for row in page:
+                yield row + (attachments.get(row[0], []),)
+            if len(page) < limit:
+                return
+            after_id = page[-1][0]
+
+    def import_entries(self, entries, batch_size=10000, progress=None):
+        """Adds all (type, ts, title, notes, attachments) of 'entries' as
+        new entries; a ts of None is the current time. Every 'batch_size'
+        entries are written with executemany in one transaction, after
+        which 'progress' is called with the number of entries so far.
+        Returns that number. An entry whose type is not in ENTRY_TYPES
+        raises ValueError; the batches before it stay imported."""
+        start = time.perf_counter()
+        n = 0
+        batch = []
+        for entry in entries:
+            if entry[0] not in ENTRY_TYPES:
+                raise ValueError("entry %i: unknown type %r" % (
+                    n + len(batch) + 1, entry[0]))
+            batch.append(entry)
+            if len(batch) == batch_size:
+                n += self.import_batch(batch)
+                batch = []
+                if progress is not None:
+                    progress(n)
+        if batch:
+            n += self.import_batch(batch)
+            if progress is not None:
+                progress(n)
+        log_event('import_entries', start, n=n)
+        return n
+
+    def import_batch(self, batch):
+        now = time.time()
+        rows = [(entry_type, now if ts is None else ts, title, notes)
+                for entry_type, ts, title, notes, __ in batch]
+        with self.transaction():
+            self.begin_write()
+            # the full-text index is filled by one executemany instead of a
+            # trigger per row, which is several times faster; the triggers
+            # are created again before the commit, so other connections
+            # never miss them
+            triggers = self.drop_triggers(
+                'search_entry_insert', 'search_attachment_insert')
+            self.cursor.executemany(
+                "INSERT INTO entries(type, ts, title, notes) VALUES(?, ?, ?, ?)", rows)
+            # AUTOINCREMENT ids are consecutive within the write transaction
+            first = self.current_id() - len(rows)
+            self.cursor.executemany(
+                "INSERT OR IGNORE INTO attachments(id, attachment) VALUES(?, ?)",
+                [(id, attachment)
+                 for id, entry in enumerate(batch, first)
+                 for attachment in entry[4]])
+            self.cursor.executemany(
+                "INSERT INTO search(rowid, title, notes, attachments) VALUES(?, ?, ?, ?)",
+                [(id, title, notes, ' '.join(entry[4]))
+                 for id, (entry, (__, __, title, notes)) in enumerate(zip(batch, rows), first)])
+            for sql in triggers:
+                self.cursor.execute(sql)
+            for id, (entry_type, ts, title, __) in enumerate(rows, first):
+                self.publish(Change(INSERTED, id, entry_type, ts, title))
+        return len(rows)
+
+    def begin_write(self):
+        """Starts the write transaction now, if none is open, so that rows
+        read before the first write cannot be changed by other instances
+        until the commit."""
+        if not self.con.in_transaction:
+            self.cursor.execute("BEGIN IMMEDIATE")
+
+    def drop_triggers(self, *names):
+        """Drops the triggers 'names' and returns the SQL to create them."""
+        self.cursor.execute((
+            "SELECT name, sql FROM sqlite_master WHERE type = 'trigger' "
+            "AND name IN ({})").format(', '.join('?' * len(names))), names)
+        triggers = self.cursor.fetchall()
+        for name, __ in triggers:
+            self.cursor.execute("DROP TRIGGER {}".format(name))
+        return [sql for __, sql in triggers]
+
+    def info(self):
+        """Returns numbers about the database: schema version, size, tasks,
+        infos, attachments, archived entries, files of the attachment store
+        and the length of the change log."""
+        with self.transaction():
+            info = {'schema_version': self.schema_version()}
+            self.cursor.execute("PRAGMA page_count")
+            page_count = self.cursor.fetchone()[0]
+            self.cursor.execute("PRAGMA page_size")
+            info['size'] = page_count * self.cursor.fetchone()[0]
+            for name, query in (
+                    ('tasks', "SELECT COUNT(*) FROM entries WHERE type = 0"),
+                    ('infos', "SELECT COUNT(*) FROM entries WHERE type = 1"),
+                    ('attachments', "SELECT COUNT(*) FROM attachments"),
+                    ('archived', "SELECT COUNT(*) FROM archive"),
+                    ('blobs', "SELECT COUNT(*) FROM blobs"),
+                    ('changes', "SELECT COUNT(*) FROM changes")):
+                self.cursor.execute(query)
+                info[name] = self.cursor.fetchone()[0]
+            return info
+
+
+
+class CachedMedikom(object):
+    """ This class puts a read-through cache in front of Medikom: a
+    size-bounded LRU of get_entry and get_header results and the result of
+    get_titles.
+    Every change published by Medikom (own mutations and, via
+    poll_changes, those of other instances) invalidates exactly the
+    affected entry. All other attributes are those of Medikom."""
+    def __init__(self, Medikom, size=256):
+        self.Medikom = Medikom
+        self.size = size
+        self.entries = OrderedDict()    # (method, id) -> result, LRU first
+        self.titles = None
+        self.generation = 0     # incremented by every invalidation
+        self.lock = threading.Lock()
+        self.counts = dict(hits=0, misses=0, evictions=0, invalidations=0)
+        Medikom.subscribe(self.invalidate)
+
+    def __getattr__(self, name):
+        return getattr(self.Medikom, name)
+
+    def invalidate(self, change):
+        with self.lock:
+            self.generation += 1
+            self.titles = None
+            for key in (('get_entry', change.id), ('get_header', change.id)):
+                if self.entries.pop(key, None) is not None:
+                    self.counts['invalidations'] += 1
+
+    def cached(self, func, id):
+        key = (func.__name__, id)
+        with self.lock:
+            if key in self.entries:
+                self.counts['hits'] += 1
+                self.entries.move_to_end(key)
+                return self.entries[key]
+            self.counts['misses'] += 1
+            generation = self.generation
+        results = func(id)
+        with self.lock:
+            # a change committed during the query makes the result stale
+            if generation == self.generation and results[0] is not None:
+                self.entries[key] = results
+                if len(self.entries) > self.size:
+                    self.entries.popitem(last=False)
+                    self.counts['evictions'] += 1
+        return results
+
+    def get_entry(self, id):
+        return self.cached(self.Medikom.get_entry, id)
+
+    def get_header(self, id):
+        return self.cached(self.Medikom.get_header, id)
+
+    def get_titles(self):
+        with self.lock:
+            if self.titles is not None:
+                self.counts['hits'] += 1
+                return self.titles
+            self.counts['misses'] += 1
+            generation = self.generation
+        titles = self.Medikom.get_titles()
+        with self.lock:
+            if generation == self.generation:
+                self.titles = titles
+        return titles
+
+    def poll_changes(self, since):
+        changes, position = self.Medikom.poll_changes(since)
+        if changes is None:
+            # the change log does not tell what changed
+            with self.lock:
+                self.generation += 1
+                self.titles = None
+                self.entries.clear()
+        return changes, position
+
+    def stats(self):
+        """Returns the numbers of hits, misses, evictions and
+        invalidations."""
+        with self.lock:
+            return dict(self.counts)
+
+
+class Worker(object):
+    """ This class runs Medikom calls on a background thread (with its own
+    connection), so that a slow disk or a locked database never blocks the
+    Tk mainloop. Jobs run in the order they were submitted. Tk is not
+    thread-safe, therefore results are not handed to their callbacks by the
+    worker thread but by deliver(), which the Gui calls periodically from
+    its mainloop (after())."""
+    def __init__(self):
+        self.jobs = queue.Queue()
+        self.done = queue.Queue()   # (callback, result) ready for delivery
+        self.thread = threading.Thread(
+            target=self.run, name='medikom-worker', daemon=True)
+        self.thread.start()
+
+    def submit(self, func, *args, callback=None, errback=None):
+        """Runs func(*args) on the worker thread. callback(result) or
+        errback(exception) is called later by deliver()."""
+        self.jobs.put((func, args, callback, errback))
+
+    def post(self, callback, result):
+        """Hands 'result' to 'callback' on the thread calling deliver(). Can
+        be used from any thread, e.g. by subscribers of Medikom."""
+        self.done.put((callback, result))
+
+    def run(self):
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                self.jobs.task_done()
+                return
+            func, args, callback, errback = job
+            try:
+                result = func(*args)
+            except Exception as error:
+                if errback is None:
+                    log_event('error', level=logging.ERROR, func=func.__name__,
+                              error=traceback.format_exc())
+                else:
+                    self.post(errback, error)
+            else:
+                if callback is not None:
+                    self.post(callback, result)
+            self.jobs.task_done()
+
+    def deliver(self):
+        """Runs the callbacks of all finished jobs. A callback that raises
+        is logged and does not hold up the others."""
+        while True:
+            try:
+                callback, result = self.done.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                callback(result)
+            except Exception:
+                log_event('error', level=logging.ERROR,
+                          func=getattr(callback, '__name__', str(callback)),
+                          error=traceback.format_exc())
+
+    def stream(self, iterable, callback, cancelled=None):
+        """Iterates 'iterable' on the worker thread and hands each item to
+        'callback', followed by None at the end. Iteration stops early once
+        cancelled() is true."""
+        self.submit(self.post_each, iterable, callback, cancelled)
+
+    def post_each(self, iterable, callback, cancelled):
+        for item in iterable:
+            if cancelled is not None and cancelled():
+                return
+            self.post(callback, item)
+        self.post(callback, None)
+
+    def flush(self):
+        """Waits for all submitted jobs and delivers their results."""
+        self.jobs.join()
+        self.deliver()
+
+    def stop(self):
+        """Finishes the submitted jobs and ends the worker thread."""
+        self.jobs.put(None)
+        self.thread.join()
@@ -0,0 +1,234 @@
+"""
+    medikom is a simple GUI program for organizing tasks and information.
+    Copyright (C) 2016 Georg Alexander Murzik (murzik@mailbox.org)
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+    Online backups with the sqlite3 backup API. The database is copied a few
+    pages per step; the source is locked during a step only, so the Gui and
+    other instances keep working while a snapshot is written.
+"""
+
+import os
+import glob
+import time
+import sqlite3
+import logging
+import threading
+import traceback
+
+from medikom_log import log_event
+
+
+class Restarted(Exception):
+    """ Raised by copy when the source was changed too often."""
+
+
+class Cancelled(Exception):
+    """ Raised by copy when it was cancelled."""
+
+
+def copy(source, target, pages=256, pause=0.005, max_restarts=3, cancelled=None):
+    """Copies the database of the connection 'source' into the connection
+    'target', 'pages' pages per step with a pause of 'pause' seconds between
+    steps. A write of another connection restarts the copy; after
+    'max_restarts' restarts the rest is copied in one step. Returns the
+    number of steps and restarts and the total and longest time a step held
+    the source locked (seconds)."""
+    result = dict(steps=0, restarts=0, pages=0, lock=0.0, max_lock=0.0)
+    previous = None     # pages remaining after the previous step
+    start = time.perf_counter()
+
+    def step_done(held):
+        result['steps'] += 1
+        result['lock'] += held
+        result['max_lock'] = max(result['max_lock'], held)
+
+    def progress(status, remaining, total):
+        nonlocal previous, start
+        step_done(time.perf_counter() - start)
+        result['pages'] = total
+        if previous is not None and remaining > previous:
+            result['restarts'] += 1
+            if result['restarts'] > max_restarts:
+                raise Restarted()
+        previous = remaining
+        if cancelled is not None and cancelled.is_set():
+            raise Cancelled()
+        if remaining:
+            time.sleep(pause)
+        start = time.perf_counter()
+
+    try:
+        source.backup(target, pages=pages, progress=progress)
+    except Restarted:
+        start = time.perf_counter()
+        source.backup(target)
+        step_done(time.perf_counter() - start)
+    return result
+
+
+def check(con):
+    """Raises sqlite3.DatabaseError if the database of 'con' fails PRAGMA
+    integrity_check."""
+    problems = [row[0] for row in con.execute("PRAGMA integrity_check")]
+    if problems != ['ok']:
+        raise sqlite3.DatabaseError(
+            "integrity check failed: %s" % '; '.join(problems[:10]))
+
+
+def restore(Medikom, path):
+    """Replaces the database of 'Medikom' by the snapshot 'path' after
+    checking it. The current database is copied to <database>.before-restore
+    first. Other instances should be closed: their overview is not
+    updated."""
+    start = time.perf_counter()
+    # sqlite3.connect would create a missing file
+    if not os.path.isfile(path):
+        raise FileNotFoundError("no snapshot: %s" % path)
+    snapshot = sqlite3.connect(path)
+    try:
+        check(snapshot)
+        current = sqlite3.connect(Medikom.path, timeout=Medikom.timeout)
+        try:
+            saved = sqlite3.connect(Medikom.path + '.before-restore')
+            try:
+                current.backup(saved)
+            finally:
+                saved.close()
+            # one step: the database is locked until the copy is complete
+            snapshot.backup(current)
+        finally:
+            current.close()
+    finally:
+        snapshot.close()
+    # the snapshot may be older than the current schema
+    Medikom.migrate()
+    log_event('restore', start, path=path)
+
+
+class Backups(object):
+    """ This class writes snapshots of the database of a Medikom to
+    'directory' (named <database>-YYYYmmdd-HHMMSS.sqlite, with -01, -02,
+    ... for more snapshots in the same second) and keeps the newest 'keep'
+    of them. Durations and lock times are logged and, with
+    'stats', recorded as Backups.snapshot and Backups.lock."""
+    PAGES = 256         # pages per step of the backup API
+    PAUSE = 0.005       # seconds between steps, for the other connections
+    MAX_RESTARTS = 3    # see copy
+
+    def __init__(self, directory, keep=24, stats=None):
+        self.directory = directory
+        self.keep = keep
+        self.stats = stats
+        os.makedirs(directory, exist_ok=True)
+
+    def prefix(self, Medikom):
+        return os.path.splitext(os.path.basename(Medikom.path))[0]
+
+    def snapshots(self, Medikom):
+        """Returns the paths of the snapshots of 'Medikom', oldest first."""
+        paths = glob.glob(os.path.join(
+            glob.escape(self.directory),
+            glob.escape(self.prefix(Medikom)) + '-*.sqlite'))
+        # without '.sqlite', -HHMMSS sorts before -HHMMSS-01
+        return sorted(paths, key=lambda path: path[:-len('.sqlite')])
+
+    def reserve(self, Medikom):
+        """Returns the path of a new snapshot, whose temporary file
+        <path>.tmp it creates. A snapshot is never overwritten: later ones
+        of the same second are numbered."""
+        stamp = time.strftime('%Y%m%d-%H%M%S')
+        for n in range(100):
+            path = os.path.join(self.directory, '%s-%s%s.sqlite' % (
+                self.prefix(Medikom), stamp, '-%02i' % n if n else ''))
+            # the temporary file exists until it is renamed to 'path', so
+            # of two snapshots (e.g. the Scheduler and 'medikom.py backup')
+            # the second finds one of them
+            try:
+                os.close(os.open(path + '.tmp', os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+            except FileExistsError:
+                continue
+            if not os.path.exists(path):
+                return path
+            os.remove(path + '.tmp')
+        raise FileExistsError("too many snapshots in one second: %s" % path)
+
+    def snapshot(self, Medikom, cancelled=None):
+        """Writes a checked snapshot of the database of 'Medikom' and deletes
+        the oldest ones. Returns its path."""
+        start = time.perf_counter()
+        path = self.reserve(Medikom)
+        temp = path + '.tmp'
+        try:
+            source = sqlite3.connect(Medikom.path, timeout=Medikom.timeout)
+            target = sqlite3.connect(temp)
+            try:
+                result = copy(source, target, self.PAGES, self.PAUSE,
+                              self.MAX_RESTARTS, cancelled)
+                # a single file that can be copied and opened on its own
+                target.execute("PRAGMA journal_mode = DELETE")
+                check(target)
+            finally:
+                target.close()
+                source.close()
+            os.replace(temp, path)
+        finally:
+            if os.path.exists(temp):
+                os.remove(temp)
+        removed = self.rotate(Medikom)
+        log_event('backup', start, path=path, size=os.path.getsize(path),
+                  steps=result['steps'], restarts=result['restarts'],
+                  pages=result['pages'], lock=round(result['lock'], 6),
+                  max_lock=round(result['max_lock'], 6), removed=removed)
+        if self.stats is not None:
+            self.stats.record('Backups.snapshot', time.perf_counter() - start)
+            self.stats.record('Backups.lock', result['max_lock'])
+        return path
+
+    def rotate(self, Medikom):
+        """Deletes all but the newest 'keep' snapshots. Returns their
+        number."""
+        snapshots = self.snapshots(Medikom)
+        old = snapshots[:max(0, len(snapshots) - self.keep)]
+        for path in old:
+            os.remove(path)
+        return len(old)
+
+
+class Scheduler(object):
+    """ This class writes a snapshot with Backups every 'interval' seconds
+    on its own thread. stop() cancels a snapshot in progress."""
+    def __init__(self, backups, Medikom, interval=3600):
+        self.backups = backups
+        self.Medikom = Medikom
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(
+            target=self.run, name='medikom-backup', daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.backups.snapshot(self.Medikom, self.stopped)
+            except Cancelled:
+                return
+            except Exception:
+                log_event('error', level=logging.ERROR, func='Scheduler.run',
+                          error=traceback.format_exc())
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
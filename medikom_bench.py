@@ -0,0 +1,383 @@
+"""
+    medikom is a simple GUI program for organizing tasks and information.
+    Copyright (C) 2016 Georg Alexander Murzik (murzik@mailbox.org)
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import sqlite3
+import argparse
+import platform
+import tempfile
+import subprocess
+
+from medikom_back_end import Medikom, CachedMedikom
+from medikom_front_end import Gui
+from medikom_stats import count_widgets
+
+WORDS = [
+    'Fernleihe', 'Rückruf', 'Müller', 'Öffnungszeiten', 'Drucker', 'Ausweis',
+    'Mahnung', 'Schlüssel', 'Kasse', 'Bestellung', 'Lieferung', 'Zeitschrift',
+    'Scanner', 'Führung', 'Schulung', 'Katalog', 'Rechnung', 'Heizung',
+    'Beamer', 'Reservierung', 'Abholung', 'Gebühren', 'Software', 'Urlaub']
+
+
+class MedikomV1(Medikom):
+    """ Medikom on schema version 1 (medikom <= 2.0), for comparisons."""
+    def migrate(self, target=1):
+        super().migrate(target)
+
+
+class HeadlessGui(Gui):
+    """ Gui that builds its (withdrawn) window without entering the mainloop,
+    so that it can be driven by the benchmarks. Tk still needs a display;
+    on servers run the benchmarks with xvfb-run."""
+    def mainloop(self, n=0):
+        self.withdraw()
+
+    def settle(self, rounds=1000):
+        """Processes background results and Tk events until the worker is
+        idle and the notes are loaded."""
+        for __ in range(rounds):
+            self.worker.flush()
+            self.update()
+            if not self.worker.jobs.unfinished_tasks and not self.notes_chunks:
+                return
+
+
+def generate(medikom, entries, seed=0):
+    """Fills 'medikom' with 'entries' synthetic entries: titles of 2-6 words
+    (5 % with '!' priority), notes with log-normal length (median about
+    300 characters, a few of them hundreds of KB) and 0-3 attachments per
+    entry. The same seed gives the same board. Returns the ids."""
+    rng = random.Random(seed)
+
+    def text(words):
+        return ' '.join(rng.choice(WORDS) for __ in range(words))
+
+    rows = []
+    for i in range(entries):
+        title = '%s %i' % (text(rng.randint(1, 5)), i)
+        if rng.random() < 0.05:
+            title = '!' + title
+        notes = text(int(rng.lognormvariate(3.7, 1.2)))
+        rows.append((rng.randint(0, 1), title, notes))
+    with medikom.bulk():
+        ids = medikom.add_entries(rows)
+        medikom.add_attachments(
+            (id, '/home/mediathek/Dokumente/%s_%i_%i.pdf' % (rng.choice(WORDS), id, n))
+            for id in ids for n in range(rng.choice((0, 0, 0, 1, 1, 2, 3))))
+    return ids
+
+
+def summarize(timings):
+    """Summarizes timings (seconds) in milliseconds."""
+    timings = sorted(timings)
+    return dict(
+        n=len(timings),
+        min_ms=timings[0] * 1000,
+        median_ms=timings[len(timings) // 2] * 1000,
+        p95_ms=timings[min(len(timings) - 1, int(len(timings) * 0.95))] * 1000,
+        max_ms=timings[-1] * 1000)
+
+
+def measure(func, n):
+    timings = []
+    for __ in range(n):
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+    return summarize(timings)
+
+
+def best_of(func, repeat=5):
+    return measure(func, repeat)['min_ms'] / 1000
+
+
+def micro(entries, seed=0, repeat=200):
+    """Times every Medikom method on a generated board of 'entries'
+    entries. Full scans run 5 times, everything else 'repeat' times."""
+    rng = random.Random(seed)
+    medikom = Medikom('micro-%i.sqlite' % entries)
+    ids = generate(medikom, entries, seed)
+    new_ids = []
+    attached = []
+    archived = []
+    results = {}
+
+    def text():
+        return ' '.join(rng.choice(WORDS) for __ in range(3))
+
+    def attach():
+        id = rng.choice(ids)
+        attachment = '/tmp/anhang-%i.pdf' % len(attached)
+        medikom.add_attachment(id, attachment)
+        attached.append((id, attachment))
+
+    def archive():
+        id = ids[len(archived)]
+        medikom.archive_entry(id)
+        archived.append(id)
+
+    operations = [
+        ('add_entry', lambda: new_ids.append(medikom.add_entry(0, text(), 'Notiz')), repeat),
+        ('edit_title', lambda: medikom.edit_title(rng.choice(ids), text()), repeat),
+        ('edit_notes', lambda: medikom.edit_notes(rng.choice(ids), text() * 20), repeat),
+        ('add_attachment', attach, repeat),
+        ('rm_attachment', lambda: medikom.rm_attachment(*attached.pop()), repeat),
+        ('rm_entry', lambda: medikom.rm_entry(new_ids.pop()), repeat),
+        ('archive_entry', archive, repeat),
+        ('restore_entry', lambda: medikom.restore_entry(archived.pop()), repeat),
+        ('add_entries[1000]', lambda: medikom.add_entries(
+            (1, text(), 'Notiz') for __ in range(1000)), 5),
+        ('get_entry', lambda: medikom.get_entry(rng.choice(ids)), repeat),
+        ('get_header', lambda: medikom.get_header(rng.choice(ids)), repeat),
+        ('iter_notes', lambda: list(medikom.iter_notes(rng.choice(ids))), repeat),
+        ('count_entries', lambda: medikom.count_entries(0), repeat),
+        ('get_titles_page', lambda: medikom.get_titles_page(
+            0, rng.randrange(entries // 2 or 1), 30), repeat),
+        ('iter_titles[1000]', lambda: [row for row, __ in zip(
+            medikom.iter_titles(0), range(1000))], repeat),
+        ('get_titles', medikom.get_titles, 5),
+        ('search', lambda: medikom.search(rng.choice(WORDS)[:4], 0, 500), 20),
+        ('poll_changes', lambda: medikom.poll_changes(medikom.change_position()), repeat),
+    ]
+    for name, func, n in operations:
+        results[name] = measure(func, n)
+    medikom.close()
+    return results
+
+
+def macro(entries, clicks=500, edits=50, seed=0):
+    """Scenario 'open app, click 'clicks' entries, edit 'edits' notes' on a
+    generated board, driven through a withdrawn Gui."""
+    rng = random.Random(seed)
+    medikom = Medikom('macro-%i.sqlite' % entries)
+    ids = generate(medikom, entries, seed)
+    cached = CachedMedikom(medikom)
+
+    start = time.perf_counter()
+    gui = HeadlessGui(cached)
+    gui.settle()
+    open_time = time.perf_counter() - start
+
+    click_timings = []
+    for __ in range(clicks):
+        start = time.perf_counter()
+        gui.view_details(cached, rng.choice(ids))
+        gui.settle()
+        click_timings.append(time.perf_counter() - start)
+
+    edit_timings = []
+    for __ in range(edits):
+        id = rng.choice(ids)
+        gui.view_details(cached, id)
+        gui.settle()
+        # replace the notes and save them like 'Text Aktualisieren'
+        textframe = gui.autosave.textframe
+        textframe.delete(1.0, 'end')
+        textframe.insert('end', 'Notiz %f' % rng.random())
+        start = time.perf_counter()
+        gui.autosave.save()
+        gui.settle()
+        edit_timings.append(time.perf_counter() - start)
+
+    results = dict(
+        open_ms=open_time * 1000,
+        click=summarize(click_timings),
+        edit_notes=summarize(edit_timings),
+        widgets=count_widgets(gui),
+        cache=cached.stats())
+    gui.close()
+    medikom.close()
+    return results
+
+
+def widget_count(entries=1000, clicks=5000, step=500, seed=0):
+    """Clicks randomly through the overview of a board with 'entries' entries
+    and returns the Tk widget count after every 'step' clicks."""
+    rng = random.Random(seed)
+    medikom = Medikom()
+    generate(medikom, entries, seed)
+    gui = HeadlessGui(medikom)
+    tasks_results, information_results = medikom.get_titles()
+    rows = tasks_results + information_results
+    counts = {0: count_widgets(gui)}
+    for click in range(1, clicks + 1):
+        id, __, title = rng.choice(rows)
+        action = rng.random()
+        if action < 0.8:
+            gui.view_details(medikom, id)
+        elif action < 0.9:
+            gui.view_edit_title(medikom, id, title)
+        else:
+            gui.view_new_title(medikom, rng.randint(0, 1))
+        gui.worker.flush()
+        if click % step == 0:
+            gui.update_idletasks()
+            counts[click] = count_widgets(gui)
+    gui.close()
+    return counts
+
+
+def get_titles_timing(entries=100000, seed=0):
+    """Times Medikom.get_titles on schema version 1 and, after the upgrade,
+    on the current schema."""
+    rng = random.Random(seed)
+    medikom = MedikomV1()
+    with medikom.con:
+        medikom.cursor.executemany(
+            "INSERT INTO entries VALUES(?, ?, ?, ?, ?)",
+            ((id, rng.randint(0, 1), rng.uniform(0, 1e9), 'Eintrag %i' % id, '')
+             for id in range(entries)))
+    before = best_of(medikom.get_titles)
+    medikom.close()
+    after = best_of(Medikom().get_titles)
+    return dict(schema_v1_ms=before * 1000, current_schema_ms=after * 1000)
+
+
+def search_timing(entries=100000, seed=0):
+    """Times Medikom.search for a few prefix queries."""
+    medikom = Medikom()
+    generate(medikom, entries, seed)
+    return {query: best_of(lambda: medikom.search(query, 0, 500)) * 1000
+            for query in ['m', 'mul', 'fernleihe', 'ruck 12']}
+
+
+def navigation(entries=1000, clicks=5000, working_set=10, seed=0):
+    """Clicks 'clicks' times back and forth between 'working_set' entries
+    through CachedMedikom, editing one of them every 100 clicks. Returns the
+    cache statistics and the number of SQL statements executed."""
+    rng = random.Random(seed)
+    medikom = Medikom()
+    ids = generate(medikom, entries, seed)
+    cached = CachedMedikom(medikom)
+    statements = []
+    medikom.con.set_trace_callback(statements.append)
+    working_set = rng.sample(ids, working_set)
+    for click in range(clicks):
+        id = rng.choice(working_set)
+        cached.get_entry(id)
+        if click % 100 == 99:
+            cached.edit_notes(id, 'Notiz %i' % click)
+    medikom.con.set_trace_callback(None)
+    results = cached.stats()
+    results['sql_statements'] = len(statements)
+    return results
+
+
+def import_time(module, repeat=5):
+    """Returns the best time of importing 'module' in a new interpreter,
+    less the start of the interpreter itself."""
+    def best(code):
+        times = []
+        for __ in range(repeat):
+            start = time.perf_counter()
+            subprocess.check_call(
+                [sys.executable, '-c', code],
+                cwd=os.path.dirname(os.path.abspath(__file__)))
+            times.append(time.perf_counter() - start)
+        return min(times)
+    return best('import ' + module) - best('pass')
+
+
+def startup(entries, seed=0):
+    """Times the start of the Gui on a board of 'entries' entries: the
+    import of the front end, and the first paint and the load of the
+    Overview without and with the snapshot saved by the last session."""
+    path = 'startup-%i.sqlite' % entries
+    medikom = Medikom(path)
+    generate(medikom, entries, seed)
+    medikom.close()
+    results = dict(import_ms=import_time('medikom_front_end') * 1000)
+    for run in ('no_snapshot', 'snapshot'):
+        gui = HeadlessGui(CachedMedikom(Medikom(path)))
+        gui.update()    # paints, the Overview is loading meanwhile
+        results[run + '_first_paint_ms'] = gui.first_paint * 1000
+        results[run + '_rows_painted'] = [
+            len(entry_list.cache) for entry_list in gui.entry_lists]
+        gui.settle()
+        results[run + '_loaded_ms'] = gui.loaded_after * 1000
+        gui.close()     # saves the snapshot
+    return results
+
+
+def metadata(args):
+    try:
+        commit = subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL,
+            cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return dict(
+        benchmark=args.benchmark, args=vars(args), commit=commit,
+        time=time.strftime('%Y-%m-%dT%H:%M:%S'),
+        python=platform.python_version(), sqlite=sqlite3.sqlite_version,
+        platform=platform.platform())
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Medikom benchmarks. Results are printed and, with '
+                    '--output, written as JSON for comparisons between commits.')
+    parser.add_argument('benchmark', choices=[
+        'micro', 'macro', 'widgets', 'get_titles', 'search', 'navigation',
+        'startup'])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000],
+                        help='board sizes for micro, macro and startup')
+    parser.add_argument('--entries', type=int, help='board size of the other benchmarks')
+    parser.add_argument('--clicks', type=int)
+    parser.add_argument('--edits', type=int, default=50)
+    parser.add_argument('--repeat', type=int, default=200)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='JSON file for the results')
+    args = parser.parse_args()
+    output = os.path.abspath(args.output) if args.output else None
+
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)
+        # the snapshots of the overview (see medikom_model.snapshot_path)
+        # go there as well, not into the cache directory of the user
+        os.environ['XDG_CACHE_HOME'] = os.environ['LOCALAPPDATA'] = tmp
+        if args.benchmark == 'micro':
+            results = {size: micro(size, args.seed, args.repeat) for size in args.sizes}
+        elif args.benchmark == 'macro':
+            results = {size: macro(size, args.clicks or 500, args.edits, args.seed)
+                       for size in args.sizes}
+        elif args.benchmark == 'widgets':
+            results = widget_count(args.entries or 1000, args.clicks or 5000, seed=args.seed)
+        elif args.benchmark == 'get_titles':
+            results = get_titles_timing(args.entries or 100000, args.seed)
+        elif args.benchmark == 'search':
+            results = search_timing(args.entries or 100000, args.seed)
+        elif args.benchmark == 'navigation':
+            results = navigation(args.entries or 1000, args.clicks or 5000, seed=args.seed)
+        elif args.benchmark == 'startup':
+            results = {size: startup(size, args.seed) for size in args.sizes}
+
+    report = dict(meta=metadata(args), results=results)
+    json.dump(report, sys.stdout, indent=2, sort_keys=True)
+    print()
+    if output:
+        with open(output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
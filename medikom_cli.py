@@ -0,0 +1,184 @@
+"""
+    medikom is a simple GUI program for organizing tasks and information.
+    Copyright (C) 2016 Georg Alexander Murzik (murzik@mailbox.org)
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+    Headless commands of medikom.py: export and import of all entries with
+    their attachments as JSONL or CSV, numbers about the database, and
+    backup and restore of snapshots. This module does not import tkinter.
+"""
+
+import sys
+import csv
+import json
+import time
+from contextlib import contextmanager
+
+import medikom_backup
+from medikom_back_end import ENTRY_TYPES
+
+FIELDS = ['id', 'type', 'ts', 'title', 'notes', 'attachments']
+
+# rows between two progress reports of export
+PROGRESS_EVERY = 10000
+
+
+def file_format(path, format):
+    """Returns 'format', or the format given by the suffix of 'path'."""
+    if format is not None:
+        return format
+    return 'csv' if path.lower().endswith('.csv') else 'jsonl'
+
+
+@contextmanager
+def open_file(path, mode):
+    """Opens 'path', or stdin/stdout for '-'."""
+    if path == '-':
+        yield sys.stdin if mode == 'r' else sys.stdout
+    else:
+        with open(path, mode, encoding='utf-8', newline='') as f:
+            yield f
+
+
+class Progress(object):
+    """ This class reports the number of processed entries and the rate on
+    stderr, overwriting the line."""
+    def __init__(self, verb, quiet=False):
+        self.verb = verb
+        self.quiet = quiet
+        self.start = time.perf_counter()
+        self.n = 0
+
+    def __call__(self, n):
+        self.n = n
+        if self.quiet:
+            return
+        duration = time.perf_counter() - self.start
+        sys.stderr.write("\r{n} Einträge {verb} ({rate:.0f}/s)".format(
+            n=n, verb=self.verb, rate=n / duration if duration else 0))
+        sys.stderr.flush()
+
+    def done(self, n):
+        self(n)
+        if not self.quiet:
+            sys.stderr.write("\n")
+
+
+def write_jsonl(f, entries):
+    for id, entry_type, ts, title, notes, attachments in entries:
+        f.write(json.dumps({
+            'id': id, 'type': entry_type, 'ts': ts, 'title': title,
+            'notes': notes, 'attachments': attachments},
+            ensure_ascii=False))
+        f.write('\n')
+        yield
+
+
+def write_csv(f, entries):
+    writer = csv.writer(f)
+    writer.writerow(FIELDS)
+    for id, entry_type, ts, title, notes, attachments in entries:
+        # one attachment per line of the cell
+        writer.writerow((id, entry_type, ts, title, notes, '\n'.join(attachments)))
+        yield
+
+
+def entry_type(value, line):
+    """Returns the type 'value' read from line 'line' as an int of
+    ENTRY_TYPES, else raises ValueError."""
+    if isinstance(value, str) and value.strip() in ('0', '1'):
+        value = int(value)
+    # bool is an int, and True == 1
+    if type(value) is not int or value not in ENTRY_TYPES:
+        raise ValueError("line %i: unknown entry type %r" % (line, value))
+    return value
+
+
+def read_jsonl(f):
+    for line, text in enumerate(f, 1):
+        if not text.strip():
+            continue
+        entry = json.loads(text)
+        yield (entry_type(entry['type'], line), entry.get('ts'), entry['title'],
+               entry.get('notes', ''), entry.get('attachments', []))
+
+
+def read_csv(f):
+    reader = csv.DictReader(f)
+    for row in reader:
+        attachments = row.get('attachments') or ''
+        yield (entry_type(row['type'], reader.line_num),
+               float(row['ts']) if row.get('ts') else None,
+               row['title'], row.get('notes', ''),
+               attachments.split('\n') if attachments else [])
+
+
+def export(Medikom, path, format=None, quiet=False):
+    """Writes all entries of 'Medikom' to 'path'. Returns their number."""
+    write = write_csv if file_format(path, format) == 'csv' else write_jsonl
+    progress = Progress('exportiert', quiet)
+    n = 0
+    with open_file(path, 'w') as f:
+        for __ in write(f, Medikom.iter_entries()):
+            n += 1
+            if n % PROGRESS_EVERY == 0:
+                progress(n)
+    progress.done(n)
+    return n
+
+
+def import_(Medikom, path, format=None, batch_size=10000, quiet=False):
+    """Adds the entries of 'path' to 'Medikom' as new entries. Returns
+    their number. Raises ValueError at the first invalid line."""
+    read = read_csv if file_format(path, format) == 'csv' else read_jsonl
+    progress = Progress('importiert', quiet)
+    with open_file(path, 'r') as f:
+        try:
+            n = Medikom.import_entries(read(f), batch_size, progress)
+        except ValueError as error:
+            # e.g. an unknown type: the batches before it are imported
+            progress.done(progress.n)
+            raise ValueError("%s (%i entries imported)" % (error, progress.n))
+    progress.done(n)
+    return n
+
+
+def stats(Medikom):
+    """Prints numbers about the database of 'Medikom'."""
+    info = Medikom.info()
+    print("Datenbank:    {path}".format(path=Medikom.path))
+    print("Version:      {schema_version}".format(**info))
+    print("Größe:        {size:.1f} MB".format(size=info['size'] / 2**20))
+    print("Aufgaben:     {tasks}".format(**info))
+    print("Infos:        {infos}".format(**info))
+    print("Anhänge:      {attachments}".format(**info))
+    print("Archiviert:   {archived}".format(**info))
+    print("Dateiablage:  {blobs}".format(**info))
+    print("Änderungslog: {changes}".format(**info))
+
+
+def backup(Medikom, directory, keep=24):
+    """Writes a snapshot of the database of 'Medikom' to 'directory'."""
+    backups = medikom_backup.Backups(directory, keep)
+    path = backups.snapshot(Medikom)
+    print("Sicherung:    {path}".format(path=path))
+    print("Sicherungen:  {n}".format(n=len(backups.snapshots(Medikom))))
+
+
+def restore(Medikom, path):
+    """Replaces the database of 'Medikom' by the snapshot 'path'."""
+    medikom_backup.restore(Medikom, path)
+    print("Wiederhergestellt aus {path}".format(path=path))
+    print("Vorheriger Stand: {path}.before-restore".format(path=Medikom.path))
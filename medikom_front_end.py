@@ -19,11 +19,21 @@
 import os
 import sys
 import time
-import subprocess
+import sqlite3
+import logging
+import threading
+import traceback
+from collections import deque
 
-from tkinter import Tk, Button, Label, Text, Scrollbar, Canvas, END
-from tkinter.messagebox import askyesno, showinfo
-from tkinter.filedialog import askopenfilename
+# subprocess, tkinter.messagebox, tkinter.filedialog and medikom_store are
+# imported where they are used, so that they do not delay the first paint
+from tkinter import Tk, Toplevel, Button, Label, Text, Entry, Listbox, Scrollbar, Canvas, StringVar, END
+
+from medikom_log import log_event
+from medikom_back_end import DELETED, Worker
+from medikom_model import (
+    Overview, OverviewSnapshot, SearchResults, save_snapshot, snapshot_path)
+from medikom_stats import GUI_METHODS, count_widgets
 
 
 class Callable(object):
@@ -44,6 +54,359 @@ class Callable(object):
         return self.func.__name__
 
 
+class EntryList(object):
+    """ This class provides one virtualized column of entries (tasks or
+    information). Only the visible rows are materialized as widgets; they are
+    filled page by page from 'source' (the in-memory Overview, or Medikom
+    itself), so the cost of a redraw does not depend on the number of
+    entries."""
+    OVERSCAN = 10   # rows fetched beyond the visible ones
+
+    def __init__(self, gui, Medikom, source, entry_type):
+        self.gui = gui
+        self.Medikom = Medikom
+        self.source = source
+        self.entry_type = entry_type
+        if entry_type == 0:   # tasks (left column)
+            self.x = gui.SPACE_TWO
+        else:   # information (right column)
+            self.x = gui.WIN_WIDTH / 2 + (.25 * gui.SPACE_ONE)
+        self.width = (gui.WIN_WIDTH / 2) - (1.25 * gui.SPACE_ONE)
+        self.count = 0
+        self.first = 0          # index of the topmost visible row
+        self.cache_start = 0    # index of the first cached row
+        self.cache = []         # (id, ts, title) of the cached rows
+        self.slots = []         # [button, rm button, y, state] per visible row
+        for i in range(gui.VISIBLE_ROWS):
+            button = Button(gui, font='Courier 10', anchor='w')
+            rm_button = Button(gui, text='√')
+            for widget in (button, rm_button):
+                widget.bind('<MouseWheel>', self.on_wheel)
+                widget.bind('<Button-4>', self.on_wheel)
+                widget.bind('<Button-5>', self.on_wheel)
+            y = (i + 1) * (gui.ROW_HIGHT + gui.ROW_SPACE)
+            self.slots.append([button, rm_button, y, None])
+        self.scrollbar = Scrollbar(gui, command=self.yview)
+
+    def refresh(self):
+        """Reloads the column after the entries have changed."""
+        self.count = self.source.count_entries(self.entry_type)
+        self.cache_start = 0
+        self.cache = []
+        self.show(self.first)
+
+    def rows(self, first, last):
+        """Returns the rows first..last-1, fetching a new page if they are not
+        cached."""
+        if first < self.cache_start or last > self.cache_start + len(self.cache):
+            self.cache_start = max(0, first - self.OVERSCAN)
+            self.cache = self.source.get_titles_page(
+                self.entry_type, self.cache_start,
+                last - self.cache_start + self.OVERSCAN)
+        return self.cache[first - self.cache_start:last - self.cache_start]
+
+    def show(self, first):
+        visible = self.gui.VISIBLE_ROWS
+        self.first = first = max(0, min(first, self.count - visible))
+        rows = self.rows(first, min(first + visible, self.count))
+        for i, slot in enumerate(self.slots):
+            if i < len(rows):
+                self.update_slot(slot, rows[i])
+            elif slot[3] is not None:
+                slot[0].place_forget()
+                slot[1].place_forget()
+                slot[3] = None
+
+        if self.count > visible:
+            self.scrollbar.place(
+                x=self.x + self.width + self.gui.SPACE_TWO + 2,
+                y=self.gui.ROW_HIGHT + self.gui.ROW_SPACE,
+                width=10, height=visible * (self.gui.ROW_HIGHT + self.gui.ROW_SPACE))
+            self.scrollbar.set(first / self.count, (first + visible) / self.count)
+        else:
+            self.scrollbar.place_forget()
+
+    def update_slot(self, slot, row):
+        """Updates the widgets of a visible row in place. Widgets are only
+        touched if their state (text, colour) has changed."""
+        button, rm_button, y, old_state = slot
+        id, ts, title = row
+        # highlight selected entries and those with priority
+        bg = self.gui.default_bg
+        if self.gui.selected_id and (id == self.gui.selected_id):
+            bg = 'lightblue'
+        if title.startswith('!'):
+            bg = 'IndianRed2'
+        state = (id, ts, title, bg)
+        if state == old_state:
+            return
+        if old_state is None:
+            button.place(x=self.x, y=y, width=self.width, height=self.gui.ROW_HIGHT)
+            rm_button.place(
+                x=self.x + self.width, y=y,
+                width=self.gui.SPACE_TWO, height=self.gui.ROW_HIGHT)
+        if old_state is None or old_state[:3] != state[:3]:
+            button.config(
+                text=self.gui.format_ts(ts) + title,
+                command=Callable(self.gui.view_details, self.Medikom, id))
+            rm_button.config(
+                command=Callable(self.gui.archive_entry, self.Medikom, id, title))
+        if old_state is None or old_state[3] != bg:
+            button.config(bg=bg)
+            rm_button.config(bg=bg)
+        slot[3] = state
+
+    def yview(self, action, value, unit=None):
+        # scrollbar protocol: ('moveto', fraction) or ('scroll', n, unit)
+        if action == 'moveto':
+            self.show(int(float(value) * self.count))
+        elif unit == 'pages':
+            self.show(self.first + int(value) * self.gui.VISIBLE_ROWS)
+        else:
+            self.show(self.first + int(value))
+
+    def on_wheel(self, event):
+        if event.num == 4 or event.delta > 0:
+            self.show(self.first - 3)
+        else:
+            self.show(self.first + 3)
+
+    def index_of(self, id):
+        for i, row in enumerate(self.cache):
+            if row[0] == id:
+                return self.cache_start + i
+        return None
+
+    def select(self, index):
+        """Shows the details of the entry at 'index' and scrolls it into view."""
+        if not self.count:
+            return
+        index = max(0, min(index, self.count - 1))
+        if index < self.first:
+            self.show(index)
+        elif index >= self.first + self.gui.VISIBLE_ROWS:
+            self.show(index - self.gui.VISIBLE_ROWS + 1)
+        id, __, __ = self.rows(index, index + 1)[0]
+        self.gui.view_details(self.Medikom, id)
+
+
+class ArchiveWindow(Toplevel):
+    """ This class provides a window to browse the archive page by page,
+    search it and restore archived entries."""
+    PAGE_SIZE = 50
+
+    def __init__(self, gui, Medikom):
+        super().__init__(gui)
+        self.gui = gui
+        self.Medikom = Medikom
+        self.rows = []      # (id, type, ts, title, archived) as listed
+        self.search_job = None
+        self.title('Archiv')
+        self.query = StringVar(self)
+        self.query.trace_add('write', self.on_search_input)
+        Entry(self, textvariable=self.query, font='Liberation 10').pack(fill='x')
+        self.listbox = Listbox(self, font='Courier 10', width=100, height=20)
+        self.listbox.pack(fill='both', expand=True)
+        self.more_button = Button(self, text='Mehr laden', command=self.load_page)
+        self.more_button.pack(side='left')
+        restore_button = Button(self, text='Wiederherstellen', command=self.restore)
+        restore_button.pack(side='right')
+        self.load_page()
+
+    def load_page(self):
+        after = self.rows[-1] if self.rows else None
+        self.gui.worker.submit(
+            self.Medikom.get_archive_page, after, self.PAGE_SIZE,
+            callback=Callable(self.show_rows, ''))
+
+    def on_search_input(self, *__):
+        if self.search_job is not None:
+            self.after_cancel(self.search_job)
+        self.search_job = self.after(self.gui.SEARCH_DELAY, self.run_search)
+
+    def run_search(self):
+        self.search_job = None
+        query = self.query.get().strip()
+        self.rows = []
+        self.listbox.delete(0, END)
+        if query:
+            self.gui.worker.submit(
+                self.Medikom.search_archive, query, None, self.gui.SEARCH_LIMIT,
+                callback=Callable(self.show_rows, query))
+        else:
+            self.load_page()
+
+    def show_rows(self, query, rows):
+        if not self.winfo_exists() or query != self.query.get().strip():
+            return  # closed, or outdated as the user kept typing
+        self.rows += rows
+        for id, entry_type, ts, title, archived in rows:
+            kind = 'Aufgabe | ' if entry_type == 0 else 'Info    | '
+            self.listbox.insert(END, self.gui.format_ts(archived) + kind + title)
+        # search results come at once, pages until a page is not full
+        more = not query and len(rows) == self.PAGE_SIZE
+        self.more_button.config(state='normal' if more else 'disabled')
+
+    def restore(self):
+        selection = self.listbox.curselection()
+        if not selection:
+            return
+        index = selection[0]
+        id = self.rows.pop(index)[0]
+        self.listbox.delete(index)
+        self.gui.worker.submit(self.Medikom.restore_entry, id)
+
+
+class NotesAutosave(object):
+    """ This class saves the notes of the details view once the user has
+    stopped typing for AUTOSAVE_DELAY. Saves run on the worker thread, one
+    at a time; edits made during a save are saved after it. Unchanged notes
+    are not saved. The saves amend one revision, which is ended by commit
+    (the update button), by leaving the entry and after REVISION_WINDOW."""
+    def __init__(self, gui, Medikom, id, textframe):
+        self.gui = gui
+        self.Medikom = Medikom
+        self.id = id
+        self.textframe = textframe
+        self.saved = None   # notes as loaded or last saved, None if stopped
+        self.job = None     # pending after() of save
+        self.saving = False
+        self.dirty = False  # modified during a save
+        self.rev = None     # revision amended by the saves, None: add one
+        self.opened = 0.0   # time.monotonic() the revision was added
+        self.ending = False # commit pending until the running save is done
+
+    def start(self):
+        """Starts tracking modifications, once the notes are loaded."""
+        self.saved = self.text()
+        self.textframe.edit_modified(False)
+        self.textframe.bind('<<Modified>>', self.on_modified)
+
+    def text(self):
+        # 'end-1c': without the newline Tk appends to the text
+        return self.textframe.get(1.0, 'end-1c')
+
+    def amend(self):
+        if self.rev is None:
+            return None
+        if time.monotonic() - self.opened >= self.gui.REVISION_WINDOW:
+            return None
+        return self.rev
+
+    def on_modified(self, *__):
+        if not self.textframe.edit_modified():
+            return  # the event of resetting the flag below
+        self.textframe.edit_modified(False)
+        if self.job is not None:
+            self.gui.after_cancel(self.job)
+        self.job = self.gui.after(self.gui.AUTOSAVE_DELAY, self.save)
+
+    def save(self):
+        if self.job is not None:
+            self.gui.after_cancel(self.job)
+            self.job = None
+        if self.saved is None:
+            return
+        if self.saving:
+            self.dirty = True
+            return
+        notes = self.text()
+        if notes == self.saved:
+            if self.ending:
+                self.ending = False
+                self.rev = None
+            return
+        self.saving = True
+        self.gui.worker.submit(
+            self.Medikom.edit_notes, self.id, notes, self.amend(),
+            callback=Callable(self.done, notes), errback=self.failed)
+
+    def commit(self):
+        """Saves now and ends the revision: the next save adds a new one."""
+        self.ending = True
+        self.save()
+
+    def done(self, notes, rev):
+        self.saving = False
+        if self.saved is None:
+            return
+        self.saved = notes
+        if rev is not None and rev != self.rev:
+            self.rev = rev
+            self.opened = time.monotonic()
+        if self.dirty:
+            self.dirty = False
+            self.save()
+        elif self.ending:
+            self.ending = False
+            self.rev = None
+
+    def failed(self, error):
+        log_event('autosave', level=logging.ERROR, id=self.id, error=repr(error))
+        self.saving = False
+        self.dirty = False
+        self.ending = False
+        self.rev = None
+
+    def stop(self):
+        """Saves pending modifications now, e.g. before the text widget is
+        destroyed, and stops."""
+        if self.job is not None:
+            self.gui.after_cancel(self.job)
+            self.job = None
+        if self.saved is not None:
+            notes = self.text()
+            if notes != self.saved:
+                self.gui.worker.submit(
+                    self.Medikom.edit_notes, self.id, notes, self.amend())
+        self.saved = None
+
+
+class RevisionWindow(Toplevel):
+    """ This class provides a window listing the revisions of the notes of
+    one entry. Selecting a revision shows its changes against the revision
+    before it."""
+    def __init__(self, gui, Medikom, id, title):
+        super().__init__(gui)
+        self.gui = gui
+        self.Medikom = Medikom
+        self.id = id
+        self.revisions = []     # (rev, ts, size)
+        self.title('Versionen von %s' % title)
+        self.listbox = Listbox(self, font='Courier 10', width=40, height=20)
+        self.listbox.pack(side='left', fill='y')
+        self.listbox.bind('<<ListboxSelect>>', self.on_select)
+        self.textframe = Text(self, font='Courier 10', width=80, height=20)
+        self.textframe.pack(side='right', fill='both', expand=True)
+        gui.worker.submit(Medikom.list_revisions, id, callback=self.show_revisions)
+
+    def show_revisions(self, revisions):
+        if not self.winfo_exists():
+            return
+        self.revisions = revisions
+        for rev, ts, size in revisions:
+            self.listbox.insert(END, 'Version %i | %s' % (rev, self.gui.format_ts(ts)[:-3]))
+        if not revisions:
+            self.textframe.insert(END, 'Der Text wurde noch nicht geändert.')
+
+    def on_select(self, *__):
+        selection = self.listbox.curselection()
+        if not selection:
+            return
+        rev = self.revisions[selection[0]][0]
+        if rev == 0:
+            func, args = self.Medikom.get_revision, (self.id, rev)
+        else:
+            func, args = self.Medikom.diff_revisions, (self.id, rev - 1, rev)
+        self.gui.worker.submit(func, *args, callback=self.show_text)
+
+    def show_text(self, text):
+        if not self.winfo_exists():
+            return
+        self.textframe.delete(1.0, END)
+        self.textframe.insert(END, text or '')
+
+
 class Gui(Tk):
     """ This class provides static GUI functionalities for Medikom."""
     # General GUI settings
@@ -54,21 +417,179 @@ class Gui(Tk):
     SPACE_ONE = 60
     SPACE_TWO = 30
     TEXT_FRAME_LINES = 8    # 16
+    VISIBLE_ROWS = 7    # 16
+    SEARCH_DELAY = 250  # ms without typing before the search is run
+    SEARCH_LIMIT = 500  # hits per column
+    POLL_INTERVAL = 20  # ms between deliveries of background results
+    SYNC_INTERVAL = 1000    # ms between checks for changes of other instances
+    RELOAD_CHANGES = 1000   # more changes of other instances reload the overview
+    STATS_INTERVAL = 1000   # ms between updates of the statistics window
+    AUTOSAVE_DELAY = 1000   # ms without typing before the notes are saved
+    REVISION_WINDOW = 600   # s the autosaves amend the same revision
+    SNAPSHOT_ROWS = 100     # rows per column saved for the next start
+    LOAD_RETRY = 5000       # ms before a failed load of the overview is retried
+    TITLE = 'Informationsverwaltung der Mediathek 2.0'
     selected_id = None
 
-    def __init__(self, Medikom):
+    def __init__(self, Medikom, stats=None, store=None, started=None):
+        # time-to-first-paint is measured from 'started' (perf_counter)
+        self.started = time.perf_counter() if started is None else started
+        self.first_paint = None     # seconds until the window was painted
+        self.loaded_after = None    # seconds until the Overview was loaded
         super().__init__()
-        self.title('Informationsverwaltung der Mediathek 2.0')
+        self.stats = stats
+        self.store = store      # AttachmentStore, or None for plain paths
+        self.scanner = None
+        self.copies = []        # threads copying attachments into the store
+        if stats is not None:
+            stats.instrument(self, GUI_METHODS, 'Gui.', action=True)
+            self.bind('<F12>', self.view_stats)
+        self.title(self.TITLE)
         self.geometry('{width}{sep}{hight}'.format(
             width=self.WIN_WIDTH, sep='x', hight=self.WIN_HIGHT))
-        self.update_n(Medikom)
+        self.details = []       # widgets of the lower window part
+        self.search_job = None
+        self.notes_token = None     # identifies the notes being loaded
+        self.notes_chunks = deque()
+        self.autosave = None    # NotesAutosave of the details view
+        # database calls run on the worker thread, see poll
+        self.worker = Worker()
+        if stats is not None:
+            stats.instrument_worker(self.worker)
+        if store is not None:
+            from medikom_store import Scanner
+            self.scanner = Scanner(store, Medikom)
+        self.protocol('WM_DELETE_WINDOW', self.close)
+        self.build_static(Medikom)
         self.overview(Medikom)
+        self.after_idle(self.painted)
+        self.poll()
+        self.sync(Medikom)
         self.mainloop()
 
-    def update_n(self, Medikom):
-        # return the maximum of task and information entries
-        tasks_results, information_results = Medikom.get_titles()
-        self.n = max(len(tasks_results), len(information_results)) + 1
+    def painted(self):
+        self.first_paint = time.perf_counter() - self.started
+        log_event('first_paint', duration=round(self.first_paint, 6),
+                  rows=sum(entry_list.count for entry_list in self.entry_lists))
+        if self.stats is not None:
+            self.stats.record('Gui.first_paint', self.first_paint)
+
+    def load(self, Medikom):
+        """Reads the change log position and the Overview (on the worker
+        thread). The position is read first: changes made while the model
+        is loading are applied twice rather than missed."""
+        return Medikom.change_position(), Overview(Medikom)
+
+    def submit_load(self, Medikom):
+        self.worker.submit(
+            self.load, Medikom, callback=Callable(self.loaded, Medikom),
+            errback=Callable(self.load_failed, Medikom))
+
+    def load_failed(self, Medikom, error):
+        """Keeps the snapshot on screen, marked as outdated in the window
+        title, and retries the load, e.g. after the database was locked
+        for longer than the timeout."""
+        log_event('error', level=logging.ERROR, func='Gui.load',
+                  error=''.join(traceback.format_exception(
+                      type(error), error, error.__traceback__)))
+        self.title(self.TITLE + ' (Datenbank nicht erreichbar, veraltet)')
+        self.after(self.LOAD_RETRY, self.submit_load, Medikom)
+
+    def loaded(self, Medikom, results):
+        """Replaces the snapshot painted at start by the loaded Overview and
+        starts the sync with other instances."""
+        self.sync_position, model = results
+        self.syncing = False
+        self.title(self.TITLE)
+        self.reload(model)
+        if self.selected_id is None:
+            # the column lengths set the layout of the lower window part
+            self.overview(Medikom)
+        self.loaded_after = time.perf_counter() - self.started
+        log_event('overview_loaded', duration=round(self.loaded_after, 6),
+                  rows=len(model.entries))
+        if self.stats is not None:
+            self.stats.record('Gui.overview_loaded', self.loaded_after)
+
+    def poll(self):
+        try:
+            self.worker.deliver()
+        finally:
+            self.after(self.POLL_INTERVAL, self.poll)
+
+    def sync(self, Medikom):
+        """Checks for changes made by other instances on the same database.
+        At most one check is in flight at a time."""
+        if not self.syncing:
+            self.syncing = True
+            self.worker.submit(
+                Medikom.poll_changes, self.sync_position,
+                callback=Callable(self.apply_sync, Medikom),
+                errback=self.sync_failed)
+        self.after(self.SYNC_INTERVAL, self.sync, Medikom)
+
+    def apply_sync(self, Medikom, results):
+        self.syncing = False
+        if self.sync_failures:
+            log_event('sync', failures=self.sync_failures)
+            self.sync_failures = 0
+        changes, self.sync_position = results
+        if changes is None or len(changes) > self.RELOAD_CHANGES:
+            # the change log has been pruned meanwhile, or so much has
+            # changed (e.g. an import) that loading everything is faster
+            self.worker.submit(Overview, Medikom, callback=self.reload)
+        elif changes:
+            self.apply_changes(changes)
+
+    def sync_failed(self, error):
+        """Logs the first of a series of failed checks, e.g. while the
+        database is unreachable; the next sync tries again."""
+        self.syncing = False
+        self.sync_failures += 1
+        if self.sync_failures == 1:
+            log_event('error', level=logging.ERROR, func='Gui.sync',
+                      error=''.join(traceback.format_exception(
+                          type(error), error, error.__traceback__)))
+
+    def reload(self, model):
+        if self.entry_lists[0].source is self.model:
+            for entry_list in self.entry_lists:
+                entry_list.source = model
+        self.model = model
+        self.apply_changes([])
+
+    def view_stats(self, *__):
+        """Opens a window with the statistics of medikom_stats (F12)."""
+        window = Toplevel(self)
+        window.title('Medikom Statistik')
+        textframe = Text(window, font='Courier 9', width=100, height=30)
+        textframe.pack(fill='both', expand=True)
+        self.update_stats(window, textframe)
+
+    def update_stats(self, window, textframe):
+        if not window.winfo_exists():
+            return
+        textframe.delete(1.0, END)
+        textframe.insert(END, self.stats.report())
+        self.after(self.STATS_INTERVAL, self.update_stats, window, textframe)
+
+    def close(self):
+        # finish pending writes before the window goes away
+        self.clear_details()
+        if self.scanner is not None:
+            self.scanner.stop()
+        for thread in self.copies:
+            thread.join()
+        self.worker.stop()
+        try:
+            save_snapshot(self.model, self.snapshot_path, self.SNAPSHOT_ROWS)
+        except OSError:
+            log_event('error', level=logging.ERROR, func='save_snapshot',
+                      error=traceback.format_exc())
+        stats = getattr(self.entry_lists[0].Medikom, 'stats', None)
+        if stats:
+            log_event('cache', **stats())
+        self.destroy()
 
     def format_ts(self, ts):
         date = time.strftime('%d.%m.%Y', time.gmtime(ts))
@@ -89,73 +610,96 @@ class Gui(Tk):
             day = 'So '
         return '{day}{date}{sep}'.format(day=day, date=date, sep=' | ')
 
-    def list_entries(self, Medikom, results, entry_type):
-        if entry_type == 0:   # tasks (left column)
-            x = self.SPACE_TWO
-        else:   # information (right column)
-            x = self.WIN_WIDTH / 2 + (.25 * self.SPACE_ONE)
-        for i, (id, ts, title) in enumerate(results):
-            ts = self.format_ts(ts)
-            task_button = Button(
-                self, text=ts + title, font='Courier 10', anchor='w',
-                command=Callable(self.view_details, Medikom, id))
-            task_button.place(
-                x=x, y=(i + 1) * (self.ROW_HIGHT + self.ROW_SPACE),
-                width=(self.WIN_WIDTH / 2) - (1.25 * self.SPACE_ONE),
-                height=self.ROW_HIGHT)
-            rm_task_button = Button(
-                self, text='√',
-                command=Callable(self.rm_entry, Medikom, id, title))
-            rm_task_button.place(
-                x=x + (self.WIN_WIDTH / 2) - (1.25 * self.SPACE_ONE),
-                y=(i + 1) * (self.ROW_HIGHT + self.ROW_SPACE),
-                width=self.SPACE_TWO, height=self.ROW_HIGHT)
+    def add_detail(self, widget):
+        """Registers a widget of the lower window part, which is destroyed on
+        the next call of overview."""
+        self.details.append(widget)
+        return widget
 
-            # highlight selected entries and those with priority
-            if self.selected_id and (id == self.selected_id):
-                task_button.config(bg='lightblue')
-                rm_task_button.config(bg='lightblue')
-            if title.startswith('!'):
-                task_button.config(bg='IndianRed2')
-                rm_task_button.config(bg='IndianRed2')
+    def clear_details(self):
+        self.notes_token = None
+        if self.autosave is not None:
+            self.autosave.stop()
+            self.autosave = None
+        for widget in self.details:
+            widget.destroy()
+        self.details = []
 
     def add_entry(self, Medikom, entry_type, title):
         notes = ''
-        Medikom.add_entry(entry_type, title, notes)
-        self.update_n(Medikom)
-        id = Medikom.current_id()-1
-        self.view_details(Medikom, id)
+        self.worker.submit(
+            Medikom.add_entry, entry_type, title, notes,
+            callback=Callable(self.view_details, Medikom))
 
-    def rm_entry(self, Medikom, id, title):
-        question_title = "Löschbestätigung"
-        question = "Soll Eintrag '%s' wirklich gelöscht werden?" % title
+    def archive_entry(self, Medikom, id, title):
+        from tkinter.messagebox import askyesno
+        question_title = "Archivieren"
+        question = "Soll Eintrag '%s' als erledigt archiviert werden?" % title
         if askyesno(question_title, question):
-            Medikom.rm_entry(id)
-            self.update_n(Medikom)
+            if self.selected_id == id:
+                self.selected_id = None
+            # closing the details queues the last edit of the notes, which
+            # must be saved before the entry moves to the archive
+            self.clear_details()
+            self.worker.submit(Medikom.archive_entry, id)
             self.overview(Medikom)
 
     def update_entry_title(self, Medikom, id, title):
-        Medikom.edit_title(id, title)
-        self.view_details(Medikom, id)
-
-    def update_entry_notes(self, Medikom, id, title):
-        Medikom.edit_notes(id, title)
+        self.worker.submit(Medikom.edit_title, id, title)
         self.view_details(Medikom, id)
 
     def attach_file(self, Medikom, id):
+        from tkinter.filedialog import askopenfilename
         attachment = askopenfilename()
-        if attachment:
-            try:
-                Medikom.add_attachment(id, attachment)
-                self.view_details(Medikom, id)
-            except sqlite3.IntegrityError:
-                pass
+        if not attachment:
+            return
+        if self.store is None:
+            self.worker.submit(
+                Medikom.add_attachment, id, attachment,
+                callback=lambda __: self.view_details(Medikom, id),
+                errback=Callable(self.attach_failed, attachment))
+            return
+        # the file is hashed and copied into the store on a thread of its
+        # own, so that a large file does not hold up the worker
+        self.copies = [thread for thread in self.copies if thread.is_alive()]
+        thread = threading.Thread(
+            target=self.copy_attachment, args=(Medikom, id, attachment),
+            name='medikom-attach', daemon=True)
+        self.copies.append(thread)
+        thread.start()
+
+    def copy_attachment(self, Medikom, id, attachment):
+        """Runs on a thread of its own: copies 'attachment' into the store
+        and submits the database part to the worker."""
+        try:
+            copied = self.store.copy(attachment)
+        except Exception as error:
+            self.worker.post(Callable(self.attach_failed, attachment), error)
+            return
+        self.worker.submit(
+            self.store.register, Medikom, id, attachment, *copied,
+            callback=lambda __: self.view_details(Medikom, id),
+            errback=Callable(self.attach_failed, attachment))
+
+    def attach_failed(self, attachment, error):
+        """Reports a file that could not be attached, e.g. because it cannot
+        be read or the disk of the store is full. A file that is attached
+        already (IntegrityError) is ignored."""
+        if isinstance(error, sqlite3.IntegrityError):
+            return
+        log_event('error', level=logging.ERROR, func='attach_file',
+                  attachment=attachment, error=''.join(traceback.format_exception(
+                      type(error), error, error.__traceback__)))
+        from tkinter.messagebox import showerror
+        showerror('Anhang', "Die Datei '%s' konnte nicht angehängt werden:\n%s"
+                  % (attachment, error))
 
     def unattach_file(self, Medikom, id, attachment, __):
-        Medikom.rm_attachment(id, attachment)
+        self.worker.submit(Medikom.rm_attachment, id, attachment)
         self.view_details(Medikom, id)
 
     def open_attachment(self, attachment):
+        import subprocess
         if os.name == 'posix':
             subprocess.call(['xdg-open', attachment])
         elif sys.platform.startswith('darwin'):
@@ -163,13 +707,13 @@ class Gui(Tk):
         elif os.name == 'nt':
             os.startfile(attachment)
 
-    def overview(self, Medikom):
-        # get content
-        tasks_results, information_results = Medikom.get_titles()
-
-        # clear screen
-        canvas = Canvas(self, width=self.WIN_WIDTH, height=self.WIN_HIGHT * 2)
-        canvas.place(x=0, y=0)
+    def build_static(self, Medikom):
+        """Creates the widgets that exist once per window. They are only moved
+        by overview, never recreated."""
+        self.canvas = Canvas(self, width=self.WIN_WIDTH, height=self.WIN_HIGHT * 2)
+        self.canvas.place(x=0, y=0)
+        self.separator = self.canvas.create_line(
+            0, 0, 0, 0, fill='#000001', width=1)
 
         # headers
         tasks_label = Label(self, text='Aufgaben', font='Liberation 14')
@@ -180,32 +724,143 @@ class Gui(Tk):
             x=self.WIN_WIDTH/2, y=0,
             width=self.WIN_WIDTH/2, height=self.ROW_HIGHT)
 
-        self.list_entries(Medikom, tasks_results, 0)
-        self.list_entries(Medikom, information_results, 1)
+        self.add_task_button = Button(self, text='+',
+            command=Callable(self.view_new_title, Medikom, 0))
+        self.add_info_button = Button(self, text='+',
+            command=Callable(self.view_new_title, Medikom, 1))
+        self.default_bg = self.add_task_button.cget('bg')
 
-        # lower window part
-        canvas.create_line(
-            self.SPACE_ONE, (self.n + 1.5) * (self.ROW_HIGHT + self.ROW_SPACE),
-            self.WIN_WIDTH - self.SPACE_ONE, (self.n + 1.5) * (self.ROW_HIGHT + self.ROW_SPACE),
-            fill='#000001', width=1)
+        # search box, filters both columns
+        search_label = Label(self, text='Suche:', font='Liberation 10', anchor='e')
+        search_label.place(
+            x=0, y=2, width=self.SPACE_TWO + 40, height=self.ROW_HIGHT - 4)
+        self.search_query = StringVar(self)
+        self.search_query.trace_add('write', self.on_search_input)
+        search_entry = Entry(self, textvariable=self.search_query, font='Liberation 10')
+        search_entry.place(
+            x=self.SPACE_TWO + 45, y=2,
+            width=self.WIN_WIDTH / 6, height=self.ROW_HIGHT - 4)
+        self.static_n = None
 
-        add_task_button = Button(self, text='+',
-            command=Callable(self.view_new_title, Medikom, 0))
-        add_task_button.place(
-            x=self.WIN_WIDTH / 4 - self.SPACE_TWO / 2,
-            y=self.n * (self.ROW_HIGHT + self.ROW_SPACE),
-            width=self.SPACE_TWO, height=self.ROW_HIGHT)
+        archive_button = Button(
+            self, text='Archiv', font='Liberation 10',
+            command=lambda: ArchiveWindow(self, Medikom))
+        archive_button.place(
+            x=self.WIN_WIDTH - self.SPACE_TWO - 80, y=2,
+            width=80, height=self.ROW_HIGHT - 4)
 
-        add_info_button = Button(self, text='+',
-            command=Callable(self.view_new_title, Medikom, 1))
-        add_info_button.place(
-            x=0.75 * self.WIN_WIDTH - self.SPACE_TWO / 2,
-            y=self.n * (self.ROW_HIGHT + self.ROW_SPACE),
-            width=self.SPACE_TWO, height=self.ROW_HIGHT)
+        # paint the columns as they were when the window was last closed;
+        # the Overview is loaded on the worker thread and replaces them, and
+        # there is no sync before (see loaded)
+        self.snapshot_path = snapshot_path(Medikom.path)
+        self.model = OverviewSnapshot(self.snapshot_path)
+        self.sync_position = None
+        self.syncing = True
+        self.sync_failures = 0  # failed checks in a row, see sync_failed
+        self.submit_load(Medikom)
+        self.worker.submit(Medikom.prune_changes)
+        self.entry_lists = [
+            EntryList(self, Medikom, self.model, 0),
+            EntryList(self, Medikom, self.model, 1)]
+        # changes are published on the worker thread; those of other
+        # instances arrive as one list in apply_sync
+        Medikom.subscribe(
+            Callable(self.worker.post, self.apply_changes), polled=False)
+        self.bind('<Up>', Callable(self.on_key, -1))
+        self.bind('<Down>', Callable(self.on_key, 1))
+        self.bind('<Prior>', Callable(self.on_key, -self.VISIBLE_ROWS))
+        self.bind('<Next>', Callable(self.on_key, self.VISIBLE_ROWS))
+        self.bind('<Home>', Callable(self.on_key, None))
+        self.bind('<End>', Callable(self.on_key, None))
+
+    def apply_changes(self, changes):
+        """Applies changes (a list, or a single change published by Medikom)
+        to the in-memory model. Only the affected columns are redrawn."""
+        if not isinstance(changes, list):
+            changes = [changes]
+        for change in changes:
+            self.model.apply(change)
+            if change.kind == DELETED and change.id == self.selected_id:
+                # deleted by another instance
+                self.selected_id = None
+                self.overview(self.entry_lists[0].Medikom)
+        if self.search_query.get().strip():
+            self.run_search()
+        else:
+            for entry_type in {change.type for change in changes} or (0, 1):
+                self.entry_lists[entry_type].refresh()
+
+    def on_search_input(self, *__):
+        # debounce: search once typing has paused for SEARCH_DELAY
+        if self.search_job is not None:
+            self.after_cancel(self.search_job)
+        self.search_job = self.after(self.SEARCH_DELAY, self.run_search)
+
+    def run_search(self):
+        self.search_job = None
+        query = self.search_query.get().strip()
+        if query:
+            self.worker.submit(
+                SearchResults, self.entry_lists[0].Medikom, query,
+                self.SEARCH_LIMIT, callback=Callable(self.show_search, query))
+        else:
+            self.show_search(query, self.model)
+
+    def show_search(self, query, source):
+        if query != self.search_query.get().strip():
+            return  # outdated, the user kept typing
+        for entry_list in self.entry_lists:
+            if entry_list.source is not source:
+                entry_list.source = source
+                entry_list.first = 0
+            entry_list.refresh()
+
+    def on_key(self, delta, event):
+        """Moves the selection within the column of the selected entry."""
+        if event.widget.winfo_class() in ('Text', 'Entry'):
+            return
+        if delta is None:   # Home / End
+            delta = -sys.maxsize if event.keysym == 'Home' else sys.maxsize
+        for entry_list in self.entry_lists:
+            index = entry_list.index_of(self.selected_id)
+            if index is not None:
+                entry_list.select(index + delta)
+                return
+        self.entry_lists[0].select(self.entry_lists[0].first)
+
+    def overview(self, Medikom):
+        # clear lower window part
+        self.clear_details()
+        self.focus_set()
+
+        for entry_list in self.entry_lists:
+            entry_list.refresh()
+        # the lower window part starts below the longest (visible) column
+        self.n = min(max(entry_list.count for entry_list in self.entry_lists),
+                     self.VISIBLE_ROWS) + 1
+
+        # lower window part
+        if self.static_n != self.n:
+            self.static_n = self.n
+            self.canvas.coords(
+                self.separator,
+                self.SPACE_ONE, (self.n + 1.5) * (self.ROW_HIGHT + self.ROW_SPACE),
+                self.WIN_WIDTH - self.SPACE_ONE, (self.n + 1.5) * (self.ROW_HIGHT + self.ROW_SPACE))
+            self.add_task_button.place(
+                x=self.WIN_WIDTH / 4 - self.SPACE_TWO / 2,
+                y=self.n * (self.ROW_HIGHT + self.ROW_SPACE),
+                width=self.SPACE_TWO, height=self.ROW_HIGHT)
+            self.add_info_button.place(
+                x=0.75 * self.WIN_WIDTH - self.SPACE_TWO / 2,
+                y=self.n * (self.ROW_HIGHT + self.ROW_SPACE),
+                width=self.SPACE_TWO, height=self.ROW_HIGHT)
+
+        if self.stats is not None:
+            self.stats.widgets = count_widgets(self)
 
         if self.selected_id is None:
-            selection_label = Label(
-                self, text='Kein Eintrag ausgewählt.', font='Liberation 10')
+            selection_label = self.add_detail(Label(
+                self, text='Kein Eintrag ausgewählt.', font='Liberation 10'))
             selection_label.place(
                 x=self.WIN_WIDTH / 2 - 0.125 * self.WIN_WIDTH,
                 y=(self.n + 1) * (self.ROW_HIGHT + self.ROW_SPACE),
@@ -218,20 +873,21 @@ class Gui(Tk):
             text = "Titel der neuen Aufgabe:"
         elif entry_type == 1:
             text = "Titel der neuen Information:"
-        details_label = Label(
+        details_label = self.add_detail(Label(
             self, text=text, font='Liberation 10',
-            fg='Black')
+            fg='Black'))
         details_label.place(
             x=self.SPACE_TWO / 2,
             y=(self.n + 2) * (self.ROW_HIGHT + self.ROW_SPACE),
             width=self.WIN_WIDTH - self.SPACE_TWO, height=self.ROW_HIGHT)
-        textframe = Text(self, font='Liberation 12', height=1, width=int(self.WIN_WIDTH / 4))
+        textframe = self.add_detail(Text(self, font='Liberation 12', height=1, width=int(self.WIN_WIDTH / 4)))
         textframe.place(
             x=self.SPACE_TWO, y=(self.n + 3) * (self.ROW_HIGHT + self.ROW_SPACE),
             width=self.WIN_WIDTH - self.SPACE_ONE - 10, height=self.ROW_HIGHT)
-        create_button = Button(
+        textframe.focus_set()
+        create_button = self.add_detail(Button(
             self, text='Erstellen',
-            command=lambda: self.add_entry(Medikom, entry_type, textframe.get(1.0, END).strip()))
+            command=lambda: self.add_entry(Medikom, entry_type, textframe.get(1.0, END).strip())))
         create_button.place(
             x=(self.WIN_WIDTH / 2) - (self.WIN_WIDTH / 16),
             y=(self.n + 4) * (self.ROW_HIGHT + self.ROW_SPACE),
@@ -240,21 +896,21 @@ class Gui(Tk):
     def view_edit_title(self, Medikom, id, old_title, *__):
         self.overview(Medikom)
         text = "Neuer Titel des Eintrags:"
-        details_label = Label(
+        details_label = self.add_detail(Label(
             self, text=text, font='Liberation 10',
-            fg='Black')
+            fg='Black'))
         details_label.place(
             x=self.SPACE_TWO / 2,
             y=(self.n + 2) * (self.ROW_HIGHT + self.ROW_SPACE),
             width=self.WIN_WIDTH - self.SPACE_TWO, height=self.ROW_HIGHT)
-        textframe = Text(self, font='Liberation 12', height=1, width=int(self.WIN_WIDTH / 4))
+        textframe = self.add_detail(Text(self, font='Liberation 12', height=1, width=int(self.WIN_WIDTH / 4)))
         textframe.place(
             x=self.SPACE_TWO, y=(self.n + 3) * (self.ROW_HIGHT + self.ROW_SPACE),
             width=self.WIN_WIDTH - self.SPACE_ONE - 10, height=self.ROW_HIGHT)
         textframe.insert(END, old_title)
-        create_button = Button(
+        create_button = self.add_detail(Button(
             self, text='Aktualisieren',
-            command=lambda: self.update_entry_title(Medikom, id, textframe.get(1.0, END).strip()))
+            command=lambda: self.update_entry_title(Medikom, id, textframe.get(1.0, END).strip())))
         create_button.place(
             x=(self.WIN_WIDTH / 2) - (self.WIN_WIDTH / 16),
             y=(self.n + 4) * (self.ROW_HIGHT + self.ROW_SPACE),
@@ -263,12 +919,20 @@ class Gui(Tk):
     def view_details(self, Medikom, id):
         self.selected_id = id
         self.overview(Medikom)
-        entry_results, attachments = Medikom.get_entry(id)
-        ts, title, notes = entry_results
+        self.worker.submit(
+            Medikom.get_header, id,
+            callback=Callable(self.show_details, Medikom, id))
+
+    def show_details(self, Medikom, id, results):
+        entry_results, attachments = results
+        if self.selected_id != id or entry_results is None:
+            return  # another entry was selected meanwhile, or it is gone
+        self.clear_details()
+        ts, title = entry_results
         ts = self.format_ts(ts)[:-3]
         details_text = 'Details zu %s (zuletzt geändert am %s)' % (title, ts)
-        details_label = Label(
-            self, text=details_text, font='Liberation 10', fg='Black', anchor='w')
+        details_label = self.add_detail(Label(
+            self, text=details_text, font='Liberation 10', fg='Black', anchor='w'))
         details_label.place(
             x=self.SPACE_TWO,
             y=(self.n + 2) * (self.ROW_HIGHT + self.ROW_SPACE),
@@ -278,26 +942,32 @@ class Gui(Tk):
             func=Callable(self.view_edit_title, Medikom, id, title))
 
         # add attachment button and list attachments
-        attach_button = Button(
+        attach_button = self.add_detail(Button(
             self, text='Neuer Anhang',
-            command=lambda: self.attach_file(Medikom, id))
+            command=lambda: self.attach_file(Medikom, id)))
         attach_button.place(
             x=self.SPACE_TWO,
             y=(self.n + 3) * (self.ROW_HIGHT + self.ROW_SPACE),
             width=self.WIN_WIDTH / 8, height=self.ROW_HIGHT)
         if attachments:
             xpos = (1.5 * self.SPACE_TWO) + (self.WIN_WIDTH / 8)
-            for i, attachment in enumerate(attachments):
-                attachment = attachment[0]
+            for i, (attachment, stored, status) in enumerate(attachments):
+                # open the copy in the store, if there is one
+                path = attachment
+                if stored is not None and self.store is not None:
+                    path = self.store.path(stored)
                 filename = ''
                 if '\\' in attachment:
                     filename = attachment.split('\\')[-1]
                 elif '/' in attachment:
                     filename = attachment.split('/')[-1]
                 width = len(filename) * 7.2
-                attachment_button = Button(
-                    self, text=filename, font='Courier 9', fg="blue",
-                    command=Callable(self.open_attachment, attachment))
+                # files the scanner found missing or changed are red ('ok'
+                # is medikom_store.OK)
+                attachment_button = self.add_detail(Button(
+                    self, text=filename, font='Courier 9',
+                    fg='blue' if status in (None, 'ok') else 'red',
+                    command=Callable(self.open_attachment, path)))
                 attachment_button.place(
                     x=xpos,
                     y=(self.n + 3) * (self.ROW_HIGHT + self.ROW_SPACE),
@@ -308,10 +978,10 @@ class Gui(Tk):
                     func=Callable(self.unattach_file, Medikom, id, attachment))
 
         # text element and scrollbar
-        textframe = Text(
+        textframe = self.add_detail(Text(
             self, font='Liberation 12', height=self.TEXT_FRAME_LINES,
-            width=int(self.WIN_WIDTH / 4))
-        scrollbar = Scrollbar(self)
+            width=int(self.WIN_WIDTH / 4)))
+        scrollbar = self.add_detail(Scrollbar(self))
         textframe.place(
             x=self.SPACE_TWO,
             y=(self.n + 4) * (self.ROW_HIGHT + self.ROW_SPACE),
@@ -324,14 +994,49 @@ class Gui(Tk):
             height=self.ROW_HIGHT * self.TEXT_FRAME_LINES)
         scrollbar.config(command=textframe.yview)
         textframe.config(yscrollcommand=scrollbar.set)
-        textframe.insert(END, notes)
 
-        # update button
-        update_button = Button(
-            self, text='Text Aktualisieren',
-            command=lambda: self.update_entry_notes(
-                Medikom, id, textframe.get(1.0, END)))
+        # notes are saved automatically; the update button saves them at
+        # once, ends their revision and is enabled once the notes are loaded
+        self.autosave = NotesAutosave(self, Medikom, id, textframe)
+        update_button = self.add_detail(Button(
+            self, text='Text Aktualisieren', state='disabled',
+            command=self.autosave.commit))
         update_button.place(
             x=self.WIN_WIDTH / 2 - 0.125 * self.WIN_WIDTH,
             y=(self.n + 4) * (self.ROW_HIGHT + self.ROW_SPACE) + (self.ROW_HIGHT * self.TEXT_FRAME_LINES + 5),
             width=self.WIN_WIDTH/4, height=self.ROW_HIGHT)
+        revisions_button = self.add_detail(Button(
+            self, text='Versionen',
+            command=lambda: RevisionWindow(self, Medikom, id, title)))
+        revisions_button.place(
+            x=self.WIN_WIDTH / 2 + 0.125 * self.WIN_WIDTH + self.SPACE_TWO / 2,
+            y=(self.n + 4) * (self.ROW_HIGHT + self.ROW_SPACE) + (self.ROW_HIGHT * self.TEXT_FRAME_LINES + 5),
+            width=self.WIN_WIDTH / 8, height=self.ROW_HIGHT)
+
+        # the notes are streamed in chunks and inserted one chunk per event
+        # loop iteration, so that long notes do not freeze the window
+        token = self.notes_token = object()
+        self.notes_chunks = deque()
+        self.worker.stream(
+            Medikom.iter_notes(id),
+            Callable(self.add_notes_chunk, token, textframe, update_button),
+            cancelled=lambda: self.notes_token is not token)
+
+    def add_notes_chunk(self, token, textframe, update_button, chunk):
+        if token is not self.notes_token:
+            return
+        self.notes_chunks.append(chunk)
+        if len(self.notes_chunks) == 1:
+            self.after_idle(self.insert_notes, token, textframe, update_button)
+
+    def insert_notes(self, token, textframe, update_button):
+        if token is not self.notes_token:
+            return
+        chunk = self.notes_chunks.popleft()
+        if chunk is None:   # all notes loaded
+            update_button.config(state='normal')
+            self.autosave.start()
+            return
+        textframe.insert(END, chunk)
+        if self.notes_chunks:
+            self.after(1, self.insert_notes, token, textframe, update_button)
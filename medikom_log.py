@@ -0,0 +1,176 @@
+"""
+    medikom is a simple GUI program for organizing tasks and information.
+    Copyright (C) 2016 Georg Alexander Murzik (murzik@mailbox.org)
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import os
+import glob
+import json
+import time
+import queue
+import atexit
+import logging
+from logging.handlers import (
+    QueueHandler, QueueListener, RotatingFileHandler, TimedRotatingFileHandler)
+
+# all events of Medikom are logged to this logger; without setup() it has no
+# handlers and the events are dropped after the level check
+logger = logging.getLogger('medikom')
+
+
+def log_event(op, start=None, level=logging.INFO, **fields):
+    """Logs the event 'op' with the JSON serializable 'fields', e.g. id and
+    type of the entry. If 'start' (a time.perf_counter() value) is given,
+    the duration since then is added. Nothing is built if 'level' is
+    disabled."""
+    if not logger.isEnabledFor(level):
+        return
+    if start is not None:
+        fields['duration'] = round(time.perf_counter() - start, 6)
+    logger.log(level, op, extra={'fields': fields})
+
+
+class JsonFormatter(logging.Formatter):
+    """Formats a record as one JSON line: time, level, op and the fields
+    given to log_event."""
+    def format(self, record):
+        event = {
+            'time': round(record.created, 6),
+            'level': record.levelname,
+            'op': record.getMessage()}
+        event.update(getattr(record, 'fields', {}))
+        if record.exc_info:
+            event['error'] = self.formatException(record.exc_info)
+        return json.dumps(event, ensure_ascii=False)
+
+
+class LazyQueueHandler(QueueHandler):
+    """Puts records on the queue as they are, so that they are formatted by
+    the listener thread and not by the thread that logs."""
+    def prepare(self, record):
+        return record
+
+
+def setup(filename='medikom.log', level=logging.INFO,
+          max_bytes=5 * 2**20, backup_count=5, when=None):
+    """Logs the events of Medikom to 'filename' on a background thread.
+    The file is rotated after 'max_bytes', or at 'when' (see
+    TimedRotatingFileHandler) if given, and 'backup_count' old files are
+    kept. Returns the QueueListener, which is stopped at exit."""
+    if when is None:
+        handler = RotatingFileHandler(
+            filename, maxBytes=max_bytes, backupCount=backup_count,
+            encoding='utf-8')
+    else:
+        handler = TimedRotatingFileHandler(
+            filename, when=when, backupCount=backup_count, encoding='utf-8')
+    handler.setFormatter(JsonFormatter())
+    records = queue.SimpleQueue()
+    listener = QueueListener(records, handler)
+    logger.addHandler(LazyQueueHandler(records))
+    logger.setLevel(level)
+    logger.propagate = False
+    listener.start()
+    atexit.register(stop, listener)
+    return listener
+
+
+def stop(listener):
+    """Writes the queued records and stops 'listener', if still running."""
+    if listener._thread is not None:
+        listener.stop()
+
+
+def log_files(filename='medikom.log'):
+    """Returns 'filename' and its rotated files, oldest first."""
+    def age(path):
+        suffix = path[len(filename) + 1:]
+        # RotatingFileHandler counts up (.1 is the newest),
+        # TimedRotatingFileHandler appends the date
+        return (0, -int(suffix)) if suffix.isdigit() else (1, suffix)
+    rotated = sorted(glob.glob(glob.escape(filename) + '.*'), key=age)
+    return rotated + [filename] if os.path.exists(filename) else rotated
+
+
+def read_events(filename='medikom.log', op=None, id=None, since=None):
+    """Yields the logged events as dicts, oldest first, optionally only
+    those of operation 'op', of entry 'id' or logged after 'since' (unix
+    time). Lines of other operations are skipped without parsing them."""
+    needle = None if op is None else json.dumps(op, ensure_ascii=False)
+    for path in log_files(filename):
+        with open(path, encoding='utf-8') as f:
+            for line in f:
+                if needle is not None and needle not in line:
+                    continue
+                try:
+                    event = json.loads(line)
+                except ValueError:
+                    continue    # e.g. a line of the old free text log
+                if op is not None and event.get('op') != op:
+                    continue
+                if id is not None and event.get('id') != id:
+                    continue
+                if since is not None and event['time'] <= since:
+                    continue
+                yield event
+
+
+def logged_notes(event, source):
+    """Returns the notes of a logged add_entry or edit_notes event. Only
+    their size and revision are logged; the text is taken from the
+    revisions (or, for entries never edited, the notes) of entry 'id' in
+    'source', the Medikom of the logged database. Logs of older versions
+    contain the notes themselves."""
+    if 'notes' in event:
+        return event['notes']
+    if not event.get('size'):
+        return ''
+    if source is None:
+        raise ValueError("the log has no notes, pass the logged database as 'source'")
+    notes = source.get_revision(event['id'], event.get('rev', 0))
+    if notes is None and event['op'] == 'add_entry':
+        notes = ''.join(source.iter_notes(event['id']))
+    return notes or ''
+
+
+def replay(events, Medikom, source=None):
+    """Applies the mutations of the logged 'events' to 'Medikom', e.g. to
+    rebuild a database from the log. Notes are taken from 'source' (see
+    logged_notes). Ids are mapped to the ids of the entries created by the
+    replay. Returns that mapping."""
+    ids = {}
+    for event in events:
+        op = event['op']
+        if op == 'add_entry':
+            ids[event['id']] = Medikom.add_entry(
+                event['type'], event['title'], logged_notes(event, source))
+        elif event.get('id') not in ids:
+            continue    # entry created before the start of the log
+        elif op == 'rm_entry':
+            Medikom.rm_entry(ids.pop(event['id']))
+        elif op == 'edit_title':
+            Medikom.edit_title(ids[event['id']], event['title'])
+        elif op == 'edit_notes':
+            Medikom.edit_notes(ids[event['id']], logged_notes(event, source))
+        elif op == 'add_attachment':
+            Medikom.add_attachment(ids[event['id']], event['attachment'])
+        elif op == 'rm_attachment':
+            Medikom.rm_attachment(ids[event['id']], event['attachment'])
+        elif op == 'archive_entry':
+            Medikom.archive_entry(ids[event['id']])
+        elif op == 'restore_entry':
+            Medikom.restore_entry(ids[event['id']])
+    return ids
@@ -0,0 +1,142 @@
+"""
+    medikom is a simple GUI program for organizing tasks and information.
+    Copyright (C) 2016 Georg Alexander Murzik (murzik@mailbox.org)
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import os
+import json
+import hashlib
+import tempfile
+from bisect import bisect_left, insort
+
+from medikom_back_end import DELETED
+
+
+class Overview(object):
+    """ This class keeps the titles of all entries in memory, sorted like the
+    overview (newest first). It is loaded once and then kept up to date by
+    applying the changes published by Medikom, so that listing entries needs
+    no database queries. It provides the same paging interface as Medikom."""
+    def __init__(self, Medikom):
+        self.keys = ([], [])    # per type: sorted (-ts, -id)
+        self.entries = {}       # id -> (type, ts, title)
+        for entry_type in (0, 1):
+            # rows arrive in overview order, keys are sorted already
+            for id, ts, title in Medikom.iter_titles(entry_type):
+                self.keys[entry_type].append((-ts, -id))
+                self.entries[id] = (entry_type, ts, title)
+
+    def apply(self, change):
+        """Applies a Change. The old position is found by bisection."""
+        old = self.entries.pop(change.id, None)
+        if old is not None:
+            entry_type, ts, __ = old
+            keys = self.keys[entry_type]
+            i = bisect_left(keys, (-ts, -change.id))
+            if i < len(keys) and keys[i] == (-ts, -change.id):
+                del keys[i]
+        if change.kind != DELETED:
+            insort(self.keys[change.type], (-change.ts, -change.id))
+            self.entries[change.id] = (change.type, change.ts, change.title)
+
+    def count_entries(self, entry_type):
+        return len(self.keys[entry_type])
+
+    def get_titles_page(self, entry_type, offset, limit):
+        results = []
+        for __, id in self.keys[entry_type][offset:offset + limit]:
+            __, ts, title = self.entries[-id]
+            results.append((-id, ts, title))
+        return results
+
+
+class OverviewSnapshot(Overview):
+    """ This class holds the first rows of each column of an Overview as
+    saved by save_snapshot, so that the window can be painted before the
+    database is read. A missing or unreadable file gives empty columns."""
+    def __init__(self, path):
+        self.keys = ([], [])
+        self.entries = {}
+        self.hidden = [0, 0]    # per type: rows not in the snapshot
+        try:
+            with open(path, encoding='utf-8') as f:
+                columns = json.load(f)['columns']
+            for entry_type in (0, 1):
+                for id, ts, title in columns[entry_type]['rows']:
+                    self.keys[entry_type].append((-ts, -id))
+                    self.entries[id] = (entry_type, ts, title)
+                self.hidden[entry_type] = (
+                    columns[entry_type]['count'] - len(self.keys[entry_type]))
+        except (OSError, ValueError, LookupError, TypeError):
+            self.keys = ([], [])
+            self.entries = {}
+            self.hidden = [0, 0]
+
+    def count_entries(self, entry_type):
+        return len(self.keys[entry_type]) + self.hidden[entry_type]
+
+
+def snapshot_path(database):
+    """Returns the path of the snapshot of the overview of the database file
+    'database' in the cache directory of the user. It is kept per
+    workstation: next to a database on a share, every workstation would
+    overwrite it."""
+    if os.name == 'nt':
+        cache = os.environ.get('LOCALAPPDATA') or os.path.expanduser('~')
+    else:
+        cache = os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache')
+    # one file per database, also for databases of the same name
+    database = os.path.abspath(database)
+    name = hashlib.sha256(database.encode('utf-8')).hexdigest()[:16]
+    return os.path.join(cache, 'medikom', '%s-%s.overview.json' % (
+        os.path.splitext(os.path.basename(database))[0], name))
+
+
+def save_snapshot(model, path, rows=100):
+    """Saves the first 'rows' rows of each column and the number of entries
+    of 'model' for OverviewSnapshot. The file is replaced atomically."""
+    columns = [
+        {'count': model.count_entries(entry_type),
+         'rows': model.get_titles_page(entry_type, 0, rows)}
+        for entry_type in (0, 1)]
+    directory = os.path.dirname(path) or '.'
+    os.makedirs(directory, exist_ok=True)
+    # a temporary file of its own, so that two instances closing at once
+    # do not write into the same one
+    fd, temp = tempfile.mkstemp(
+        dir=directory, prefix=os.path.basename(path), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump({'columns': columns}, f, ensure_ascii=False)
+        os.replace(temp, path)
+    except BaseException:
+        os.remove(temp)
+        raise
+
+
+class SearchResults(object):
+    """ This class holds the search hits of both columns (best matches
+    first) and provides the same paging interface as Overview."""
+    def __init__(self, Medikom, query, limit):
+        self.results = (
+            [(id, ts, title) for id, __, ts, title in Medikom.search(query, 0, limit)],
+            [(id, ts, title) for id, __, ts, title in Medikom.search(query, 1, limit)])
+
+    def count_entries(self, entry_type):
+        return len(self.results[entry_type])
+
+    def get_titles_page(self, entry_type, offset, limit):
+        return self.results[entry_type][offset:offset + limit]
@@ -0,0 +1,59 @@
+"""
+    medikom is a simple GUI program for organizing tasks and information.
+    Copyright (C) 2016 Georg Alexander Murzik (murzik@mailbox.org)
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+    Encoding of notes revisions: a snapshot is the compressed text, a delta
+    the compressed list of line ranges copied from the previous revision and
+    lines inserted between them, e.g. [[0, 12], "new line\n", [13, 40]].
+"""
+
+import json
+import zlib
+
+# every SNAPSHOT_INTERVAL-th revision is stored in full, so that at most
+# SNAPSHOT_INTERVAL - 1 deltas are applied to rebuild a revision
+SNAPSHOT_INTERVAL = 20
+
+
+def encode_snapshot(text):
+    return zlib.compress(text.encode('utf-8'))
+
+
+def encode_delta(old, new):
+    """Returns the compressed delta that turns 'old' into 'new'."""
+    from difflib import SequenceMatcher
+    old_lines = old.splitlines(keepends=True)
+    new_lines = new.splitlines(keepends=True)
+    ops = []
+    matcher = SequenceMatcher(None, old_lines, new_lines)
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == 'equal':
+            ops.append([i1, i2])
+        elif j2 > j1:
+            ops.append(''.join(new_lines[j1:j2]))
+    return zlib.compress(json.dumps(ops, ensure_ascii=False).encode('utf-8'))
+
+
+def decode(data, is_snapshot, previous=None):
+    """Returns the text of a revision from its stored 'data' and, for a
+    delta, the text of the 'previous' revision."""
+    data = zlib.decompress(data).decode('utf-8')
+    if is_snapshot:
+        return data
+    old_lines = previous.splitlines(keepends=True)
+    return ''.join(
+        op if isinstance(op, str) else ''.join(old_lines[op[0]:op[1]])
+        for op in json.loads(data))
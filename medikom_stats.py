@@ -0,0 +1,258 @@
+"""
+    medikom is a simple GUI program for organizing tasks and information.
+    Copyright (C) 2016 Georg Alexander Murzik (murzik@mailbox.org)
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import math
+import time
+import sqlite3
+import threading
+from collections import deque
+from functools import wraps
+
+# Medikom methods whose calls are recorded
+MEDIKOM_METHODS = [
+    'add_entry', 'add_entries', 'rm_entry', 'edit_title', 'edit_notes',
+    'add_attachment', 'add_attachments', 'rm_attachment', 'get_titles',
+    'count_entries', 'get_titles_page', 'search', 'get_entry', 'get_header',
+    'poll_changes', 'prune_changes', 'archive_entry', 'restore_entry',
+    'get_archive_page', 'search_archive', 'list_revisions', 'get_revision',
+    'diff_revisions']
+
+# Gui methods (UI actions) whose calls are recorded
+GUI_METHODS = [
+    'overview', 'view_details', 'show_details', 'view_new_title',
+    'view_edit_title', 'run_search', 'show_search', 'apply_changes']
+
+
+def count_widgets(widget):
+    children = widget.winfo_children()
+    return len(children) + sum(count_widgets(child) for child in children)
+
+
+class CountingCursor(sqlite3.Cursor):
+    """ Cursor that counts the rows it fetches."""
+    stats = None
+
+    def fetchone(self):
+        row = super().fetchone()
+        if row is not None:
+            self.stats.count_rows(1)
+        return row
+
+    def fetchmany(self, *args):
+        rows = super().fetchmany(*args)
+        self.stats.count_rows(len(rows))
+        return rows
+
+    def fetchall(self):
+        rows = super().fetchall()
+        self.stats.count_rows(len(rows))
+        return rows
+
+
+class Histogram(object):
+    """ Latency histogram with power-of-two buckets (in microseconds)."""
+    BUCKETS = 32
+
+    def __init__(self):
+        self.buckets = [0] * self.BUCKETS
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.statements = 0
+        self.rows = 0
+
+    def add(self, seconds, statements, rows):
+        us = seconds * 1e6
+        self.buckets[min(self.BUCKETS - 1, int(math.log2(us)) if us >= 1 else 0)] += 1
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+        self.statements += statements
+        self.rows += rows
+
+    def percentile(self, p):
+        """Upper bound of the bucket holding the p-th percentile, in
+        seconds."""
+        rank = p / 100 * self.count
+        seen = 0
+        for bucket, n in enumerate(self.buckets):
+            seen += n
+            if n and seen >= rank:
+                return min(2 ** (bucket + 1) / 1e6, self.max)
+        return self.max
+
+
+class Stats(object):
+    """ This class records where time goes: a latency histogram per Medikom
+    method and UI action, the SQL statements (sqlite3 trace callback) and
+    rows fetched per Medikom call, the Tk widget count after each overview
+    and the slowest recent operations. Counters are kept per thread, so
+    calls on the worker thread are attributed correctly; the statements and
+    rows of jobs a UI action submits to the Worker count for the action
+    (see instrument_worker)."""
+    RECENT = 200    # number of recent operations kept
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.histograms = {}
+        self.recent = deque(maxlen=self.RECENT)  # (seconds, name, end time)
+        self.widgets = None
+        self.statements = 0
+        self.rows = 0
+
+    def counters(self):
+        local = self.local
+        if not hasattr(local, 'statements'):
+            local.statements = local.rows = 0
+        return local
+
+    def statement(self, sql):
+        self.counters().statements += 1
+
+    def count_rows(self, n):
+        self.counters().rows += n
+
+    def connect(self, con):
+        """Instruments a new connection; returns its cursor."""
+        con.set_trace_callback(self.statement)
+        cursor = con.cursor(CountingCursor)
+        cursor.stats = self
+        return cursor
+
+    def record(self, name, seconds, statements=0, rows=0):
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram()
+            histogram.add(seconds, statements, rows)
+            self.statements += statements
+            self.rows += rows
+            self.recent.append((seconds, name, time.time()))
+
+    def add_counts(self, name, statements, rows):
+        """Adds statements and rows to 'name' without counting a call. The
+        totals are not changed: the statements were recorded already."""
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram()
+            histogram.statements += statements
+            histogram.rows += rows
+
+    def timed(self, name, func, action=False):
+        """Returns 'func' wrapped to record its calls as 'name'. Jobs
+        submitted during an 'action' are attributed to it; nested actions
+        count for the outermost one."""
+        @wraps(func)
+        def wrapper(*args, **kwds):
+            counters = self.counters()
+            statements, rows = counters.statements, counters.rows
+            outermost = action and getattr(self.local, 'action', None) is None
+            if outermost:
+                self.local.action = name
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwds)
+            finally:
+                if outermost:
+                    self.local.action = None
+                self.record(
+                    name, time.perf_counter() - start,
+                    counters.statements - statements, counters.rows - rows)
+        return wrapper
+
+    def instrument(self, obj, methods, prefix='', action=False):
+        """Replaces the given methods of 'obj' by timed wrappers. With
+        'action', they are UI actions (see timed)."""
+        for method in methods:
+            setattr(obj, method, self.timed(
+                prefix + method, getattr(obj, method), action))
+
+    def attribute(self, func):
+        """Returns 'func' wrapped so that the statements and rows of its
+        call, on whichever thread, count for the UI action running now on
+        the calling thread."""
+        action = getattr(self.local, 'action', None)
+        if action is None:
+            return func
+
+        @wraps(func)
+        def wrapper(*args, **kwds):
+            counters = self.counters()
+            statements, rows = counters.statements, counters.rows
+            try:
+                return func(*args, **kwds)
+            finally:
+                self.add_counts(
+                    action, counters.statements - statements,
+                    counters.rows - rows)
+        return wrapper
+
+    def instrument_worker(self, worker):
+        """Attributes the jobs submitted to 'worker' during a UI action to
+        the action."""
+        submit = worker.submit
+
+        def wrapper(func, *args, **kwds):
+            return submit(self.attribute(func), *args, **kwds)
+        worker.submit = wrapper
+
+    def instrument_medikom(self, Medikom):
+        """Records the calls of Medikom and the statements and rows of its
+        connections. Existing connections are closed, so that all
+        connections are opened instrumented."""
+        Medikom.close()
+        Medikom.instrumentation = self
+        self.instrument(Medikom, MEDIKOM_METHODS, 'Medikom.')
+
+    def slowest(self, n=10):
+        with self.lock:
+            return sorted(self.recent, reverse=True)[:n]
+
+    def summary(self):
+        """Returns {name: dict(count, mean_ms, p50_ms, p99_ms, max_ms,
+        statements, rows)}, statements and rows per call."""
+        with self.lock:
+            return {
+                name: dict(
+                    count=h.count,
+                    mean_ms=h.total / h.count * 1000,
+                    p50_ms=h.percentile(50) * 1000,
+                    p99_ms=h.percentile(99) * 1000,
+                    max_ms=h.max * 1000,
+                    statements=h.statements / h.count,
+                    rows=h.rows / h.count)
+                for name, h in self.histograms.items() if h.count}
+
+    def report(self):
+        lines = ['{:28} {:>7} {:>9} {:>9} {:>9} {:>6} {:>8}'.format(
+            'Operation', 'Anzahl', 'p50 ms', 'p99 ms', 'max ms', 'SQL', 'Zeilen')]
+        for name, s in sorted(self.summary().items()):
+            lines.append('{:28} {:7} {:9.2f} {:9.2f} {:9.2f} {:6.1f} {:8.1f}'.format(
+                name, s['count'], s['p50_ms'], s['p99_ms'], s['max_ms'],
+                s['statements'], s['rows']))
+        lines.append('')
+        lines.append('Widgets nach overview: {}'.format(self.widgets))
+        lines.append('SQL-Anweisungen: {}, Zeilen: {}'.format(self.statements, self.rows))
+        lines.append('')
+        lines.append('Langsamste Operationen:')
+        for seconds, name, end in self.slowest():
+            lines.append('{:9.2f} ms  {}  {}'.format(
+                seconds * 1000, time.strftime('%H:%M:%S', time.localtime(end)), name))
+        return '\n'.join(lines)
@@ -0,0 +1,183 @@
+"""
+    medikom is a simple GUI program for organizing tasks and information.
+    Copyright (C) 2016 Georg Alexander Murzik (murzik@mailbox.org)
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import os
+import time
+import hashlib
+import tempfile
+import logging
+import threading
+import traceback
+
+from medikom_log import log_event
+
+# status of a file of the store, see Medikom.set_blob_status
+OK = 'ok'
+MISSING = 'missing'
+CHANGED = 'changed'
+
+
+class AttachmentStore(object):
+    """ This class keeps a copy of each attached file in the directory
+    'root', named by the SHA-256 of its content, so that links do not break
+    when the original moves and equal files are stored once. copy, attach
+    and scan read whole files and belong on a background thread other than
+    the Worker; register is the part of attach that writes the database."""
+    CHUNK_SIZE = 1024 * 1024
+
+    def __init__(self, root):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+    def path(self, filename):
+        """Returns the path of the stored file 'filename'."""
+        return os.path.join(self.root, filename[:2], filename)
+
+    def hash_file(self, path):
+        """Returns the SHA-256 (hex) and the size of the file 'path'."""
+        sha256 = hashlib.sha256()
+        size = 0
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(self.CHUNK_SIZE), b''):
+                sha256.update(chunk)
+                size += len(chunk)
+        return sha256.hexdigest(), size
+
+    def copy(self, path):
+        """Copies 'path' to a temporary file of the store, hashing it on the
+        way. Returns the SHA-256, the size and the temporary path."""
+        start = time.perf_counter()
+        sha256 = hashlib.sha256()
+        size = 0
+        fd, temp = tempfile.mkstemp(dir=self.root, suffix='.tmp')
+        try:
+            with open(path, 'rb') as source, os.fdopen(fd, 'wb') as target:
+                for chunk in iter(lambda: source.read(self.CHUNK_SIZE), b''):
+                    sha256.update(chunk)
+                    target.write(chunk)
+                    size += len(chunk)
+        except BaseException:
+            os.remove(temp)
+            raise
+        log_event('store_copy', start, sha256=sha256.hexdigest(), size=size)
+        return sha256.hexdigest(), size, temp
+
+    def attach(self, Medikom, id, path):
+        """Adds the file 'path' as an attachment of entry 'id', with a copy
+        in the store. Files with the same content share one copy."""
+        self.register(Medikom, id, path, *self.copy(path))
+
+    def register(self, Medikom, id, path, sha256, size, temp):
+        """Adds the file 'path', which copy copied to 'temp', as an
+        attachment of entry 'id' and moves the copy into place, unless the
+        store has one already. 'temp' is removed in any case."""
+        start = time.perf_counter()
+        filename = sha256 + os.path.splitext(path)[1].lower()
+        try:
+            # registering the file and moving it into place in one write
+            # transaction excludes cleanup, which deletes under the same lock
+            with Medikom.transaction():
+                Medikom.begin_write()
+                Medikom.add_blob(sha256, size, filename)
+                # a known file keeps its name; a copy the scanner found
+                # missing or changed is replaced by the new one
+                filename, status = Medikom.get_blob(sha256)
+                Medikom.add_attachment(id, path, sha256)
+                target = self.path(filename)
+                if status != OK or not os.path.exists(target):
+                    os.makedirs(os.path.dirname(target), exist_ok=True)
+                    os.replace(temp, target)
+                    Medikom.set_blob_status(sha256, OK, time.time())
+        finally:
+            if os.path.exists(temp):
+                os.remove(temp)
+        log_event('store_attachment', start, id=id, sha256=sha256, size=size)
+
+    def scan(self, Medikom, verify_age=7 * 24 * 3600):
+        """Checks that the files of the store exist with the right size, and
+        hashes those whose content was last checked more than 'verify_age'
+        seconds ago. Changes of the status are saved. Returns (sha256,
+        filename, status) of the files that are not ok."""
+        start = time.perf_counter()
+        problems = []
+        n = 0
+        for sha256, size, filename, status, checked in Medikom.iter_blobs():
+            n += 1
+            path = self.path(filename)
+            now = time.time()
+            verified = None
+            try:
+                if os.path.getsize(path) != size:
+                    new_status = CHANGED
+                elif checked is None or now - checked > verify_age:
+                    verified = now
+                    new_status = OK if self.hash_file(path)[0] == sha256 else CHANGED
+                else:
+                    new_status = OK
+            except OSError:
+                new_status = MISSING
+            if new_status != status or verified is not None:
+                Medikom.set_blob_status(sha256, new_status, verified)
+            if new_status != OK:
+                problems.append((sha256, filename, new_status))
+        log_event('scan_store', start, n=n, problems=len(problems))
+        return problems
+
+    def cleanup(self, Medikom):
+        """Deletes the files no attachment refers to. Returns their
+        number."""
+        start = time.perf_counter()
+        n = 0
+        for sha256, filename in Medikom.unreferenced_blobs():
+            with Medikom.transaction():
+                Medikom.begin_write()
+                if Medikom.delete_blob(sha256):
+                    try:
+                        os.remove(self.path(filename))
+                    except FileNotFoundError:
+                        pass
+                    n += 1
+        log_event('cleanup_store', start, n=n)
+        return n
+
+
+class Scanner(object):
+    """ This class runs scan and cleanup of an AttachmentStore every
+    'interval' seconds on its own thread (with its own connection), so that
+    hashing large files does not hold up the Worker."""
+    def __init__(self, store, Medikom, interval=600):
+        self.store = store
+        self.Medikom = Medikom
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(
+            target=self.run, name='medikom-scanner', daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while not self.stopped.is_set():
+            try:
+                self.store.scan(self.Medikom)
+                self.store.cleanup(self.Medikom)
+            except Exception:
+                log_event('error', level=logging.ERROR, func='Scanner.run',
+                          error=traceback.format_exc())
+            self.stopped.wait(self.interval)
+
+    def stop(self):
+        self.stopped.set()
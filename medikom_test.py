@@ -0,0 +1,138 @@
+"""
+    medikom is a simple GUI program for organizing tasks and information.
+    Copyright (C) 2016 Georg Alexander Murzik (murzik@mailbox.org)
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+    Regression checks of the parts that must never break existing data: the
+    upgrade of a database of medikom <= 2.0 and the encoding of notes
+    revisions. Runs without Tk:
+
+        python3 medikom_test.py
+"""
+
+import os
+import random
+import sqlite3
+import tempfile
+import unittest
+
+from medikom_back_end import Medikom, SCHEMA_VERSION
+from medikom_revisions import encode_snapshot, encode_delta, decode
+
+
+class MedikomV1(Medikom):
+    """ Medikom that installs schema version 1 only."""
+    def migrate(self, target=1):
+        super().migrate(target)
+
+
+class UpgradeTest(unittest.TestCase):
+    """ This class upgrades a database of schema version 1, written the way
+    medikom <= 2.0 did: ids counted in configuration.current_id from 0, and
+    attachments left behind by deleted entries."""
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'v1.sqlite')
+        # the first connection installs (or upgrades) the schema
+        v1 = MedikomV1(self.path)
+        v1.schema_version()
+        v1.close()
+        # without PRAGMA foreign_keys, like medikom <= 2.0
+        con = sqlite3.connect(self.path)
+        con.executemany(
+            "INSERT INTO entries VALUES(?, ?, ?, ?, ?)", [
+                (0, 0, 1000.0, 'Rückruf Müller', 'erste\nZeile'),
+                (1, 1, 1001.0, 'Öffnungszeiten', ''),
+                (3, 0, 1003.0, 'Drucker', 'Toner')])
+        # entry 2 and the last one, 4, were deleted with rm_entry
+        con.executemany(
+            "INSERT INTO attachments VALUES(?, ?)", [
+                (0, '/home/a/brief.pdf'), (3, '/home/a/toner.txt'),
+                (2, '/home/a/weg.pdf'), (4, '/home/a/auch-weg.pdf')])
+        con.execute(
+            "UPDATE configuration SET value = 5 WHERE option = 'current_id'")
+        con.commit()
+        con.close()
+        self.medikom = Medikom(self.path)
+        self.medikom.schema_version()
+
+    def tearDown(self):
+        self.medikom.close()
+        self.directory.cleanup()
+
+    def test_schema_version(self):
+        self.assertEqual(self.medikom.schema_version(), SCHEMA_VERSION)
+
+    def test_ids_kept(self):
+        self.assertEqual(self.medikom.get_header(0)[0], (1000.0, 'Rückruf Müller'))
+        self.assertEqual(self.medikom.get_header(3)[0], (1003.0, 'Drucker'))
+        self.assertEqual(self.medikom.count_entries(0), 2)
+        self.assertEqual(self.medikom.count_entries(1), 1)
+
+    def test_ids_not_reused(self):
+        # 4 was handed out before the upgrade: the next id is current_id
+        self.assertEqual(self.medikom.add_entry(0, 'neu', ''), 5)
+
+    def test_orphan_attachments_dropped(self):
+        con = sqlite3.connect(self.path)
+        try:
+            attachments = con.execute(
+                "SELECT id, attachment FROM attachments ORDER BY id").fetchall()
+        finally:
+            con.close()
+        self.assertEqual(attachments, [
+            (0, '/home/a/brief.pdf'), (3, '/home/a/toner.txt')])
+
+    def test_search(self):
+        ids = [row[0] for row in self.medikom.search('muller', 0, 10)]
+        self.assertEqual(ids, [0])
+
+
+class RevisionsTest(unittest.TestCase):
+    """ This class checks that every delta decodes to the text it was
+    encoded from."""
+    LINES = ['Zeile\n', 'Müller\n', '\n', 'ohne Ende', 'a\r\n', 'b\r',
+             ' ', '    eingerückt\n', '']
+
+    def assertRoundTrip(self, old, new):
+        self.assertEqual(decode(encode_delta(old, new), False, old), new)
+
+    def test_snapshot(self):
+        for text in ('', 'a', 'Öffnungszeiten\nMo-Fr\n'):
+            self.assertEqual(decode(encode_snapshot(text), True), text)
+
+    def test_edge_cases(self):
+        for old, new in [('', ''), ('', 'a'), ('a', ''), ('a\n', 'a'),
+                         ('a', 'a\n'), ('a\nb\n', 'b\na\n'), ('\n\n', '\n')]:
+            self.assertRoundTrip(old, new)
+
+    def test_random_edits(self):
+        rng = random.Random(0)
+        text = ''
+        for __ in range(500):
+            lines = text.splitlines(keepends=True)
+            for __ in range(rng.randint(1, 4)):
+                i = rng.randint(0, len(lines))
+                if lines and rng.random() < 0.3:
+                    del lines[min(i, len(lines) - 1)]
+                else:
+                    lines.insert(i, rng.choice(self.LINES))
+            new = ''.join(lines)
+            self.assertRoundTrip(text, new)
+            text = new
+
+
+if __name__ == '__main__':
+    unittest.main()